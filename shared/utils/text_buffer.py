@@ -0,0 +1,46 @@
+class TextBuffer:
+    """Piece table that only joins its text when it is read."""
+
+    def __init__(self, text: str = ""):
+        # (source, start, end) slices of immutable strings, never copied
+        self._pieces = [(text, 0, len(text))] if text else []
+        self._length = len(text)
+        self._text = text
+
+    def append(self, text: str):
+        """Add text at the end."""
+        if text:
+            self._pieces.append((text, 0, len(text)))
+            self._length += len(text)
+            self._text = None
+
+    def truncate(self, characters: int) -> str:
+        """Remove the last characters and return them."""
+        if characters > self._length:
+            raise ValueError("Cannot truncate more characters than present")
+        removed = []
+        remaining = characters
+        while remaining > 0:
+            source, start, end = self._pieces.pop()
+            if end - start > remaining:
+                # Only the tail of the last piece goes, shorten it in place
+                self._pieces.append((source, start, end - remaining))
+                start = end - remaining
+            removed.append(source[start:end])
+            remaining -= end - start
+        if characters > 0:
+            self._length -= characters
+            self._text = None
+        return "".join(reversed(removed))
+
+    def __len__(self):
+        return self._length
+
+    def __str__(self):
+        if self._text is None:
+            self._text = "".join(
+                source[start:end] for source, start, end in self._pieces
+            )
+            # Later reads and appends start from a single piece
+            self._pieces = [(self._text, 0, self._length)] if self._text else []
+        return self._text
@@ -1,4 +1,19 @@
 # taken from https://tavianator.com/the-visitor-pattern-in-python/
+from collections import namedtuple
+from inspect import isgeneratorfunction
+from types import GeneratorType
+
+# Resolved argument types remembered per visitor class
+_CACHE_MAXSIZE = 128
+
+
+class VisitorCacheInfo(namedtuple("VisitorCacheInfo", "hits misses maxsize currsize")):
+    """Statistics of a visitor method's resolved-type cache."""
+
+    @property
+    def hit_rate(self):
+        calls = self.hits + self.misses
+        return self.hits / calls if calls else 0.0
 
 
 def _qualname(obj):
@@ -12,15 +27,113 @@ def _declaring_class(obj):
     return name[: name.rfind(".")]
 
 
-# Stores the actual visitor methods
-_methods = {}
+class _DispatchTable:
+    """Registered visitor methods of a class and the types resolved from them."""
+
+    def __init__(self):
+        self.methods = {}
+        self.cache = {}
+        self.iterative = False
+
+    def register(self, arg_type, fn):
+        self.methods[arg_type] = fn
+        self.iterative = self.iterative or isgeneratorfunction(fn)
+        # Subtypes may now resolve to a different method
+        self.cache.clear()
+
+    def resolve(self, arg_type):
+        for base in arg_type.__mro__:
+            if base in self.methods:
+                return self.methods[base]
+        raise KeyError(arg_type)
+
+
+# Marks an exhausted generator visitor method
+_DONE = object()
+
+# Methods decorated in a class body that is still running, by declaring
+# class and method name, until the class claims them in __set_name__
+_pending = {}
 
 
 # Delegating visitor implementation
-def _visitor_impl(self, arg):
-    """Actual visitor method implementation."""
-    method = _methods[(_qualname(type(self)), type(arg))]
-    return method(self, arg)
+def _visitor_impl(table, owner, name):
+    """Build the actual visitor method for a class dispatch table."""
+    cache = table.cache
+    hits = misses = 0
+
+    def lookup(arg_type):
+        nonlocal hits, misses
+        try:
+            method = cache[arg_type]
+            hits += 1
+        except KeyError:
+            misses += 1
+            method = table.resolve(arg_type)
+            if len(cache) >= _CACHE_MAXSIZE:
+                # Evict the oldest resolved type
+                del cache[next(iter(cache))]
+            cache[arg_type] = method
+        return method
+
+    def visit(self, arg):
+        nonlocal hits
+        try:
+            method = cache[type(arg)]
+            hits += 1
+        except KeyError:
+            method = lookup(type(arg))
+        return method(self, arg)
+
+    def walk(self, arg):
+        # Generator methods yield the nodes they want visited, so the whole
+        # tree is walked with an explicit stack instead of one Python frame
+        # per level
+        nonlocal hits
+        value = lookup(type(arg))(self, arg)
+        if type(value) is not GeneratorType:
+            return value
+        stack = [value]
+        push, pop = stack.append, stack.pop
+        while stack:
+            arg = next(stack[-1], _DONE)
+            if arg is _DONE:
+                pop()
+                continue
+            try:
+                method = cache[type(arg)]
+                hits += 1
+            except KeyError:
+                method = lookup(type(arg))
+            value = method(self, arg)
+            if type(value) is GeneratorType:
+                push(value)
+
+    def cache_info():
+        return VisitorCacheInfo(hits, misses, _CACHE_MAXSIZE, len(cache))
+
+    def register(arg_type, fn):
+        table.register(arg_type, fn)
+        # A generator method added later needs the walking dispatcher
+        if table.iterative:
+            setattr(owner, name, walk)
+
+    for dispatcher in (visit, walk):
+        dispatcher.cache_info = cache_info
+        dispatcher.register = register
+    return walk if table.iterative else visit
+
+
+class _VisitorMethod:
+    """Placeholder left in the class body until the class is created."""
+
+    def __set_name__(self, owner, name):
+        # The class now exists, give it its own table, so classes sharing a
+        # qualified name (built by the same factory) never share methods
+        table = _DispatchTable()
+        for arg_type, fn in _pending.pop((_qualname(owner), name)):
+            table.register(arg_type, fn)
+        setattr(owner, name, _visitor_impl(table, owner, name))
 
 
 # The actual @visitor decorator
@@ -28,10 +141,10 @@ def visitor(arg_type):
     """Decorator that creates a visitor method."""
 
     def decorator(fn):
-        declaring_class = _declaring_class(fn)
-        _methods[(declaring_class, arg_type)] = fn
+        key = (_declaring_class(fn), fn.__name__)
+        _pending.setdefault(key, []).append((arg_type, fn))
 
-        # Replace all decorated methods with _visitor_impl
-        return _visitor_impl
+        # Replace all decorated methods with a single per-class dispatcher
+        return _VisitorMethod()
 
     return decorator
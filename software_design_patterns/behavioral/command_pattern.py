@@ -1,18 +1,36 @@
 from abc import ABC, abstractmethod
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import Enum
+import math
+import os
+import struct
+import sys
+import threading
+import time
+from shared.utils.text_buffer import TextBuffer
 
 
 class Poem:
     def __init__(self, text: str = ""):
-        self.text = text
+        self._buffer = TextBuffer(text)
+
+    @property
+    def text(self):
+        return str(self._buffer)
+
+    @text.setter
+    def text(self, text: str):
+        self._buffer = TextBuffer(text)
 
     def write(self, text: str):
-        self.text += text
+        self._buffer.append(text)
 
     def delete(self, characters: int):
-        if characters > len(self.text):
+        if characters > len(self._buffer):
             raise ValueError("Cannot delete more characters than present")
-        self.text = self.text[:-characters]
+        return self._buffer.truncate(characters)
 
     def __str__(self):
         return self.text
@@ -40,30 +58,43 @@ class PoemCommand(Command):
         super().__init__()
         self.poem = poem
         self.action = action
-        self.undo_text = [self.poem.text]
+        # Inverse of every execution: the written length or the deleted text
+        self.undo_deltas = []
         self.text = text
         self.characters = characters
 
     def execute(self):
         if self.action == self.Action.WRITE:
-            self.undo_text.append(self.poem.text)
             self.poem.write(self.text)
+            self.undo_deltas.append(len(self.text))
             self.success = True
         elif self.action == self.Action.DELETE:
             try:
-                self.undo_text.append(self.poem.text)
-                self.poem.delete(self.characters)
+                self.undo_deltas.append(self.poem.delete(self.characters))
                 self.success = True
             except ValueError:
                 self.success = False
         return self.success
 
     def undo(self):
-        if self.success and self.action in [self.Action.WRITE, self.Action.DELETE]:
-            self.poem.text = self.undo_text.pop()
+        if self.success and self.undo_deltas:
+            delta = self.undo_deltas.pop()
+            if self.action == self.Action.WRITE:
+                self.poem.delete(delta)
+            else:
+                self.poem.write(delta)
             return True
         return False
 
+    def merge(self, command: "PoemCommand"):
+        # Folds in a command of the same action that ran right after this one
+        if self.action == self.Action.WRITE:
+            self.text += command.text
+            self.undo_deltas[-1] += command.undo_deltas[-1]
+        else:
+            self.characters += command.characters
+            self.undo_deltas[-1] = command.undo_deltas[-1] + self.undo_deltas[-1]
+
 
 class CompositePoemCommand(Command, list):
     def __init__(self, commands=[]):
@@ -80,7 +111,55 @@ class CompositePoemCommand(Command, list):
             command.undo()
 
 
-class CopyFromPoemCommand(CompositePoemCommand):
+class TransactionalPoemCommand(CompositePoemCommand):
+    # All or nothing: the first failing child rolls the executed ones back,
+    # down to the latest savepoint, so earlier work can be kept. Executing
+    # again resumes after the work that was kept
+    def __init__(self, commands=[]):
+        super().__init__(commands)
+        self.savepoints = []
+        self.executed = 0
+        # Where the latest execute started, the children before it ran earlier
+        self.started = 0
+
+    def savepoint(self):
+        self.savepoints.append(len(self))
+        return len(self)
+
+    def execute(self):
+        self.started = self.executed
+        for command in self[self.executed :]:
+            try:
+                ok = command.execute() is not False
+            except Exception:
+                self.rollback_to(self._last_savepoint())
+                raise
+            if not ok:
+                self.rollback_to(self._last_savepoint())
+                self.success = False
+                return False
+            self.executed += 1
+        self.success = True
+        return True
+
+    def _last_savepoint(self):
+        index = bisect_right(self.savepoints, self.executed)
+        return self.savepoints[index - 1] if index else 0
+
+    def rollback_to(self, savepoint: int = 0):
+        # Undoes the executed children past the savepoint, newest first
+        while self.executed > savepoint:
+            self.executed -= 1
+            self[self.executed].undo()
+
+    def undo(self):
+        if not self.executed:
+            return False
+        self.rollback_to()
+        return True
+
+
+class CopyFromPoemCommand(TransactionalPoemCommand):
     def __init__(self, from_poem: Poem, to_poem: Poem):
         super().__init__(
             [
@@ -95,6 +174,421 @@ class CopyFromPoemCommand(CompositePoemCommand):
             ]
         )
 
-    def execute(self):
-        ok = [command.execute() for command in self]
-        return all(ok)
+
+class MergePolicy(ABC):
+    # Decides whether a command can be folded into the one before it, the
+    # elapsed time between them is None when compacting older history
+    @abstractmethod
+    def can_merge(self, previous: Command, command: Command, elapsed: float) -> bool:
+        pass
+
+
+class TypingMergePolicy(MergePolicy):
+    def __init__(self, window: float = 1.0):
+        self.window = window
+
+    def can_merge(self, previous: Command, command: Command, elapsed: float) -> bool:
+        return (
+            isinstance(previous, PoemCommand)
+            and isinstance(command, PoemCommand)
+            and previous.poem is command.poem
+            and previous.action == command.action
+            and previous.success
+            and command.success
+            and len(previous.undo_deltas) == len(command.undo_deltas) == 1
+            and (elapsed is None or elapsed <= self.window)
+        )
+
+
+class CommandHistory:
+    def __init__(
+        self,
+        policy: MergePolicy = None,
+        compact_every: int = 1000,
+        keep_recent: int = 100,
+    ):
+        self.policy = policy or TypingMergePolicy()
+        self.compact_every = compact_every
+        # The latest commands keep their own undo steps when compacting
+        self.keep_recent = keep_recent
+        self.commands = []
+        self.undone = []
+        self.last_time = None
+        self.appended = 0
+        self.merged = 0
+        self.saved_bytes = 0
+
+    def execute(self, command: Command):
+        result = command.execute()
+        now = time.monotonic()
+        self.undone.clear()
+        # Nothing merges across an undo or redo, last_time is cleared there
+        if (
+            self.commands
+            and self.last_time is not None
+            and self.policy.can_merge(self.commands[-1], command, now - self.last_time)
+        ):
+            self._merge(self.commands[-1], command)
+        else:
+            self.commands.append(command)
+            self.appended += 1
+            if self.appended % self.compact_every == 0:
+                self.compact()
+        self.last_time = now
+        return result
+
+    def _merge(self, previous: Command, command: Command):
+        previous.merge(command)
+        self.merged += 1
+        self.saved_bytes += (
+            sys.getsizeof(command)
+            + sys.getsizeof(command.__dict__)
+            + sys.getsizeof(command.undo_deltas)
+        )
+
+    def compact(self):
+        older = len(self.commands) - self.keep_recent
+        if older < 2:
+            return
+        compacted = [self.commands[0]]
+        for command in self.commands[1:older]:
+            if self.policy.can_merge(compacted[-1], command, None):
+                self._merge(compacted[-1], command)
+            else:
+                compacted.append(command)
+        self.commands[:older] = compacted
+
+    def undo(self):
+        if not self.commands:
+            return False
+        command = self.commands.pop()
+        command.undo()
+        self.undone.append(command)
+        self.last_time = None
+        return True
+
+    def redo(self):
+        if not self.undone:
+            return False
+        command = self.undone.pop()
+        command.execute()
+        self.commands.append(command)
+        self.last_time = None
+        return True
+
+    def __len__(self):
+        return len(self.commands)
+
+
+def command_poems(command: Command) -> set:
+    # Every poem a command or any of its children edits
+    if isinstance(command, PoemCommand):
+        return {command.poem}
+    return set().union(*(command_poems(child) for child in command))
+
+
+class CommandJournal:
+    # Records are the edits commands made and the text every poem started
+    # from: operation, poem name length and the deleted characters or the
+    # byte length of the text that follows
+    RECORD = struct.Struct("<BHI")
+    WRITE, DELETE, SNAPSHOT = range(3)
+    # A snapshot starts with the journal offset it was taken at
+    SNAPSHOT_HEADER = struct.Struct("<Q")
+
+    def __init__(
+        self,
+        path: str,
+        poems: dict,
+        batch_size: int = 64,
+        batch_interval: float = 0.05,
+        snapshot_interval: int = 10000,
+    ):
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.poems = poems
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.snapshot_interval = snapshot_interval
+        self.pending = bytearray()
+        self.pending_records = 0
+        self.records_since_snapshot = 0
+        self.last_sync = time.monotonic()
+        # Syncs a batch left pending when no further record arrives in time
+        self.timer = None
+        self.lock = threading.RLock()
+        # The journal holds the poems it has seen, their texts replace the
+        # ones passed in while the poem objects are kept
+        replayed, end = self.replay()
+        for name, poem in replayed.items():
+            self.poems.setdefault(name, Poem()).text = poem.text
+        self.names = {poem: name for name, poem in self.poems.items()}
+        self.file = open(path, "ab")
+        # Drop a record torn by a crash in the middle of a write
+        self.file.truncate(end)
+        self.file.seek(end)
+        # Poems new to the journal start from a record of their current text
+        for name, poem in self.poems.items():
+            if name not in replayed:
+                self._append(self.SNAPSHOT, poem, poem.text)
+        self.sync()
+
+    def _records(self, data, offset: int):
+        while offset + self.RECORD.size <= len(data):
+            operation, name_size, value = self.RECORD.unpack_from(data, offset)
+            start = offset + self.RECORD.size + name_size
+            end = start if operation == self.DELETE else start + value
+            if end > len(data):
+                return
+            name = data[offset + self.RECORD.size : start].decode()
+            if operation != self.DELETE:
+                value = data[start:end].decode()
+            offset = end
+            yield operation, name, value, end
+
+    def replay(self) -> tuple:
+        # Rebuilds the journaled poems from scratch, returning them by name
+        # along with the offset the valid records end at
+        poems = {}
+        offset = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as file:
+                data = file.read()
+            (offset,) = self.SNAPSHOT_HEADER.unpack_from(data)
+            for _, name, text, _ in self._records(data, self.SNAPSHOT_HEADER.size):
+                poems[name] = Poem(text)
+        if not os.path.exists(self.path):
+            return poems, 0
+        # Only the records written after the snapshot are applied again
+        with open(self.path, "rb") as file:
+            file.seek(offset)
+            data = file.read()
+        end = 0
+        for operation, name, value, end in self._records(data, 0):
+            poem = poems.setdefault(name, Poem())
+            if operation == self.WRITE:
+                poem.write(value)
+            elif operation == self.DELETE:
+                poem.delete(value)
+            else:
+                poem.text = value
+            self.records_since_snapshot += 1
+        return poems, offset + end
+
+    def _record(self, operation: int, name: str, value) -> bytes:
+        name = name.encode()
+        if operation == self.DELETE:
+            return self.RECORD.pack(operation, len(name), value) + name
+        value = value.encode()
+        return self.RECORD.pack(operation, len(name), len(value)) + name + value
+
+    def _append(self, operation: int, poem: Poem, value):
+        with self.lock:
+            self.pending += self._record(operation, self.names[poem], value)
+            self.pending_records += 1
+            self.records_since_snapshot += 1
+            # Group commit, one fsync for the whole batch
+            if (
+                self.pending_records >= self.batch_size
+                or time.monotonic() - self.last_sync >= self.batch_interval
+            ):
+                self.sync()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.batch_interval, self.sync)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _check(self, command: Command):
+        # Refused before running, an edit the journal can't record would
+        # make the poems and the journal diverge
+        unknown = command_poems(command) - self.names.keys()
+        if unknown:
+            raise ValueError("Command edits poems missing from the journal")
+
+    def _snapshot_if_due(self):
+        # Only between commands, a composite is journaled after it has run
+        if self.records_since_snapshot >= self.snapshot_interval:
+            self.snapshot()
+
+    def execute(self, command: Command):
+        self._check(command)
+        result = command.execute()
+        self._log_execute(command)
+        self._snapshot_if_due()
+        return result
+
+    def _log_execute(self, command: Command):
+        if isinstance(command, PoemCommand):
+            if command.success:
+                if command.action == PoemCommand.Action.WRITE:
+                    self._append(self.WRITE, command.poem, command.text)
+                else:
+                    self._append(self.DELETE, command.poem, command.characters)
+        elif isinstance(command, TransactionalPoemCommand):
+            # Children past a rollback left no edits behind, and the ones
+            # kept by an earlier failed run are journaled already
+            for child in command[command.started : command.executed]:
+                self._log_execute(child)
+        else:
+            for child in command:
+                self._log_execute(child)
+
+    def undo(self, command: Command):
+        self._check(command)
+        result = self._log_undo(command)
+        self._snapshot_if_due()
+        return result
+
+    def _log_undo(self, command: Command):
+        if isinstance(command, TransactionalPoemCommand):
+            for child in reversed(command[: command.executed]):
+                self._log_undo(child)
+            command.executed = 0
+            return
+        if not isinstance(command, PoemCommand):
+            for child in reversed(command):
+                self._log_undo(child)
+            return
+        delta = command.undo_deltas[-1] if command.undo_deltas else None
+        if not command.undo():
+            return False
+        # The inverse edit is journaled like any other
+        if command.action == PoemCommand.Action.WRITE:
+            self._append(self.DELETE, command.poem, delta)
+        else:
+            self._append(self.WRITE, command.poem, delta)
+        return True
+
+    def sync(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.pending:
+                self.file.write(self.pending)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.pending.clear()
+                self.pending_records = 0
+            self.last_sync = time.monotonic()
+
+    def snapshot(self):
+        with self.lock:
+            self.sync()
+            offset = self.file.tell()
+        data = bytearray(self.SNAPSHOT_HEADER.pack(offset))
+        for name, poem in self.poems.items():
+            data += self._record(self.SNAPSHOT, name, poem.text)
+        # Replaced atomically, a crash leaves the previous snapshot in place
+        temporary_path = self.snapshot_path + ".tmp"
+        with open(temporary_path, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.snapshot_path)
+        self.records_since_snapshot = 0
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CommandBus:
+    # Commands on different poems run concurrently on a thread pool, while
+    # each command waits for the previous one scheduled on any of its poems
+    def __init__(self, max_workers: int = None, latency_window: int = 10000):
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.lock = threading.Lock()
+        self.tails = {}
+        self.depths = {}
+        self.latencies = deque(maxlen=latency_window)
+
+    targets = staticmethod(command_poems)
+
+    def execute(self, command: Command) -> Future:
+        return self._schedule(command.execute, self.targets(command))
+
+    def undo(self, command: Command) -> Future:
+        return self._schedule(command.undo, self.targets(command))
+
+    def _schedule(self, action, targets: set) -> Future:
+        future = Future()
+        submitted = time.perf_counter()
+        with self.lock:
+            previous = {
+                self.tails[target] for target in targets if target in self.tails
+            }
+            for target in targets:
+                self.tails[target] = future
+                self.depths[target] = self.depths.get(target, 0) + 1
+        waiting = len(previous)
+
+        def run():
+            try:
+                result = action()
+            except BaseException as e:
+                self._done(future, targets, submitted)
+                future.set_exception(e)
+            else:
+                self._done(future, targets, submitted)
+                future.set_result(result)
+
+        def ready(_):
+            nonlocal waiting
+            with self.lock:
+                waiting -= 1
+                if waiting:
+                    return
+            self.executor.submit(run)
+
+        if previous:
+            for tail in previous:
+                tail.add_done_callback(ready)
+        else:
+            self.executor.submit(run)
+        return future
+
+    def _done(self, future: Future, targets: set, submitted: float):
+        with self.lock:
+            self.latencies.append(time.perf_counter() - submitted)
+            for target in targets:
+                self.depths[target] -= 1
+                if not self.depths[target]:
+                    del self.depths[target]
+                if self.tails.get(target) is future:
+                    del self.tails[target]
+
+    def queue_depth(self, poem: Poem = None) -> int:
+        # Commands scheduled and not finished yet, for one poem or overall
+        with self.lock:
+            if poem is not None:
+                return self.depths.get(poem, 0)
+            return sum(self.depths.values())
+
+    def latency_percentiles(self, percentiles=(50, 90, 99)) -> dict:
+        # Seconds from scheduling to completion over the latest commands
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return {}
+        return {
+            percentile: latencies[
+                max(math.ceil(percentile / 100 * len(latencies)) - 1, 0)
+            ]
+            for percentile in percentiles
+        }
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
@@ -1,6 +1,14 @@
 from abc import ABC, abstractmethod
+import codecs
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from enum import Enum
+from hashlib import sha256
+import os
+import pickle
 import re
+from weakref import WeakKeyDictionary
+from shared.utils.visitor import visitor
 
 
 class Language(Enum):
@@ -25,6 +33,93 @@ TRANSLATION_RULES = {
 }
 
 
+# Compiled patterns per (from, to) pair, shared by every interpreter instance
+_compiled_rules = {}
+
+
+def compile_rules(language_from: Language, language_to: Language) -> list:
+    key = (language_from, language_to)
+    rules = _compiled_rules.get(key)
+    if rules is None:
+        rules = _compiled_rules[key] = [
+            (re.compile(pattern), replacement)
+            for pattern, replacement in TRANSLATION_RULES.get(key, [])
+        ]
+    return rules
+
+
+# Braces, semicolons and quotes inside string and char literals are not
+# syntax, a quote left over starts no literal and is kept as text
+_STRING = r'"(?:\\.|[^"\\\n])*"'
+_CHAR = r"'(?:\\u\{[0-9a-fA-F]*\}|\\.|[^'\\\n])'"
+_CODE = rf"(?:{_STRING}|{_CHAR}|[^;{{}}\n\"])*"
+_LITERAL = re.compile(rf"{_STRING}|{_CHAR}")
+
+
+def _rust_boundary():
+    # End of the last line closing every brace opened before it, the text
+    # is expected to start outside any block. The depth is carried between
+    # calls so only lines completed since the last one are counted, and the
+    # caller drops the text before every cut it gets
+    depth = 0
+    scanned = 0
+
+    def boundary(code: str) -> int:
+        nonlocal depth, scanned
+        cut = 0
+        end = code.find("\n", scanned)
+        while end >= 0:
+            line = _LITERAL.sub("", code[scanned:end])
+            depth += line.count("{") - line.count("}")
+            scanned = end + 1
+            if depth == 0:
+                cut = scanned
+            end = code.find("\n", scanned)
+        scanned -= cut
+        return cut
+
+    return boundary
+
+
+def _python_boundary():
+    # Start of the last unindented line, so a block and its body stay
+    # together. Only newlines added since the last call are looked at, the
+    # last one again as its next line may not have been read yet
+    scanned = 0
+
+    def boundary(code: str) -> int:
+        nonlocal scanned
+        cut = 0
+        position = code.rfind("\n", scanned)
+        while position >= 0:
+            if position + 1 < len(code) and not code[position + 1].isspace():
+                cut = position + 1
+                break
+            position = code.rfind("\n", scanned, position)
+        scanned = max(len(code) - 1 - cut, 0)
+        return cut
+
+    return boundary
+
+
+_PYTHON_ITEM = re.compile(r"(?<=\n)(?=\S)")
+
+
+def _python_items(code: str) -> list:
+    # The def rule's body capture has no closing brace to stop at, so every
+    # top-level item is translated on its own
+    return [item for item in _PYTHON_ITEM.split(code) if item]
+
+
+# Makers of the function finding where a chunk of source in each language can
+# be cut without splitting a block, and how the text before the cut is split
+# into separate translations
+STREAM_BOUNDARIES = {
+    Language.RUST: (_rust_boundary, lambda code: [code]),
+    Language.PYTHON: (_python_boundary, _python_items),
+}
+
+
 class Context:
     def __init__(self, language_from: Language, language_to: Language):
         self.language_from = language_from
@@ -43,9 +138,7 @@ class Expression(ABC):
 class GeneralInterpreter(Expression):
     def __init__(self, context: Context):
         super().__init__(context)
-        self.rules = TRANSLATION_RULES.get(
-            (context.language_from, context.language_to), []
-        )
+        self.rules = compile_rules(context.language_from, context.language_to)
 
     def interpret(self, code: str) -> str:
         if not self.rules:
@@ -53,9 +146,33 @@ class GeneralInterpreter(Expression):
                 f"No translation rules for {self.context.language_from} to {self.context.language_to}"
             )
         for pattern, replacement in self.rules:
-            code = re.sub(pattern, replacement, code)
+            code = pattern.sub(replacement, code)
         return code
 
+    def interpret_stream(self, reader, writer, chunk_size: int = 1 << 20):
+        # Reads text or bytes (files, mmap), translating whole blocks at a
+        # time so only the last unfinished one is held besides the chunk.
+        # The output doesn't depend on the chunk size
+        make_boundary, items = STREAM_BOUNDARIES[self.context.language_from]
+        boundary = make_boundary()
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        pending = ""
+        while True:
+            data = reader.read(chunk_size)
+            if not data:
+                break
+            if isinstance(data, bytes):
+                data = decoder.decode(data)
+            pending += data
+            cut = boundary(pending)
+            if cut:
+                for item in items(pending[:cut]):
+                    writer.write(self.interpret(item))
+                pending = pending[cut:]
+        pending += decoder.decode(b"", final=True)
+        for item in items(pending):
+            writer.write(self.interpret(item))
+
 
 class RustToPythonInterpreter(GeneralInterpreter):
     def __init__(self):
@@ -67,3 +184,468 @@ class PythonToRustInterpreter(GeneralInterpreter):
     def __init__(self):
         context = Context(Language.PYTHON, Language.RUST)
         super().__init__(context)
+
+
+# Interpreter of a batch worker process, built once by its initializer
+_worker_interpreter = None
+
+
+def _init_worker(interpreter: bytes):
+    global _worker_interpreter
+    _worker_interpreter = pickle.loads(interpreter)
+
+
+def _interpret_chunk(codes: list) -> list:
+    return [_worker_interpreter.interpret(code) for code in codes]
+
+
+class BatchInterpreter:
+    # Translates many sources on a pool of worker processes that keep their
+    # compiled rules between batches. Results are cached by content hash,
+    # so unchanged sources are never sent to a worker again
+    def __init__(
+        self,
+        interpreter: Expression,
+        max_workers: int = None,
+        chunksize: int = 16,
+        cache: dict = None,
+    ):
+        if not isinstance(interpreter, Expression):
+            raise TypeError("Batch translation needs an Expression interpreter")
+        self.interpreter = interpreter
+        self.chunksize = chunksize
+        # Translation by interpreter, direction and content hash, any mapping
+        # works and a shelf shared between jobs persists it
+        self.cache = {} if cache is None else cache
+        context = interpreter.context
+        cls = type(interpreter)
+        self.cache_prefix = (
+            f"{cls.__module__}.{cls.__qualname__}:"
+            f"{context.language_from.value}:{context.language_to.value}:"
+        )
+        # Every worker unpickles its own copy of the interpreter, whatever
+        # subclass it is, pickling here reports unpicklable ones right away
+        self.executor = ProcessPoolExecutor(
+            max_workers,
+            initializer=_init_worker,
+            initargs=(pickle.dumps(interpreter),),
+        )
+
+    @staticmethod
+    def _read(source) -> str:
+        # Paths are read, plain strings are the code itself
+        if isinstance(source, os.PathLike):
+            with open(source, encoding="utf-8") as file:
+                return file.read()
+        return source
+
+    def _submit(self, sources) -> tuple:
+        # Looks every source up in the cache and sends the misses to the
+        # pool in chunks, identical sources are translated only once
+        results = {}
+        missing = {}
+        for index, source in enumerate(sources):
+            code = self._read(source)
+            key = self.cache_prefix + sha256(code.encode()).hexdigest()
+            if key in self.cache:
+                results[index] = self.cache[key]
+            else:
+                missing.setdefault(key, (code, []))[1].append(index)
+        keys = list(missing)
+        futures = {}
+        for start in range(0, len(keys), self.chunksize):
+            chunk = keys[start : start + self.chunksize]
+            future = self.executor.submit(
+                _interpret_chunk, [missing[key][0] for key in chunk]
+            )
+            futures[future] = chunk
+        return results, missing, futures
+
+    def _collect(self, future, chunk: list, missing: dict):
+        for key, output in zip(chunk, future.result()):
+            self.cache[key] = output
+            for index in missing[key][1]:
+                yield index, output
+
+    def translate(self, sources) -> list:
+        sources = list(sources)
+        results, missing, futures = self._submit(sources)
+        for future, chunk in futures.items():
+            results.update(self._collect(future, chunk, missing))
+        return [results[index] for index in range(len(sources))]
+
+    def translate_as_completed(self, sources):
+        # Yields (index, translation) pairs, cached ones first
+        results, missing, futures = self._submit(sources)
+        yield from results.items()
+        for future in as_completed(futures):
+            yield from self._collect(future, futures[future], missing)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+
+class Module:
+    def __init__(self, items: tuple):
+        # One block per top-level item of the source
+        self.items = items
+
+
+class Block:
+    def __init__(self, statements: tuple):
+        self.statements = statements
+
+
+class Function:
+    def __init__(self, name: str, params: tuple, return_type: str, body: Block):
+        self.name = name
+        # (name, type) pairs, the type is None when missing
+        self.params = params
+        self.return_type = return_type
+        self.body = body
+
+
+class Compound:
+    # Any other statement owning a block, like an if or a loop
+    def __init__(self, header: str, body: Block):
+        self.header = header
+        self.body = body
+
+
+class Let:
+    def __init__(self, name: str, value: str):
+        self.name = name
+        self.value = value
+
+
+class Return:
+    def __init__(self, value: str):
+        self.value = value
+
+
+class Statement:
+    def __init__(self, text: str):
+        self.text = text
+
+
+def _parse_params(params: str) -> tuple:
+    pairs = []
+    for param in filter(None, (param.strip() for param in params.split(","))):
+        name, _, type_ = param.partition(":")
+        pairs.append((name.strip(), type_.strip() or None))
+    return tuple(pairs)
+
+
+class RustParser:
+    FUNCTION = re.compile(r"fn\s+(\w+)\s*\(([^)]*)\)\s*(?:->\s*(\w+)\s*)?\{")
+    LET = re.compile(rf"let\s+(?:mut\s+)?(\w+)\s*(?::\s*\w+\s*)?=\s*({_CODE}?)\s*;")
+    RETURN = re.compile(rf"return\s+({_CODE}?)\s*;")
+    STATEMENT = re.compile(rf"({_CODE})([;{{]?)")
+    LITERAL = _LITERAL
+    SPACE = re.compile(r"\s*")
+
+    @staticmethod
+    def split(code: str) -> list:
+        # Top-level items end on the line closing their last brace
+        items = []
+        lines = []
+        depth = 0
+        for line in code.splitlines(keepends=True):
+            lines.append(line)
+            line = RustParser.LITERAL.sub("", line)
+            depth += line.count("{") - line.count("}")
+            if depth == 0 and line.strip():
+                items.append("".join(lines))
+                lines = []
+        if lines:
+            items.append("".join(lines))
+        return items
+
+    def parse(self, code: str) -> Block:
+        block, _ = self._block(code, 0, False)
+        return block
+
+    def _block(self, code: str, position: int, nested: bool) -> tuple:
+        statements = []
+        while True:
+            position = self.SPACE.match(code, position).end()
+            if position == len(code):
+                if nested:
+                    raise ValueError("Unbalanced braces")
+                break
+            if code[position] == "}":
+                if not nested:
+                    raise ValueError("Unbalanced braces")
+                position += 1
+                break
+            match = self.FUNCTION.match(code, position)
+            if match:
+                body, position = self._block(code, match.end(), True)
+                name, params, return_type = match.groups()
+                statements.append(
+                    Function(name, _parse_params(params), return_type, body)
+                )
+                continue
+            match = self.LET.match(code, position) or self.RETURN.match(code, position)
+            if match:
+                if match.re is self.LET:
+                    statements.append(Let(*match.groups()))
+                else:
+                    statements.append(Return(match[1]))
+                position = match.end()
+                continue
+            match = self.STATEMENT.match(code, position)
+            if match.end() == position:
+                # Only an unterminated string literal stops a statement
+                raise ValueError(f"Unterminated string literal at {position}")
+            position = match.end()
+            if match[2] == "{":
+                body, position = self._block(code, position, True)
+                statements.append(Compound(match[1].strip(), body))
+            elif match[1].strip():
+                statements.append(Statement(match[1].strip()))
+        return Block(tuple(statements)), position
+
+
+class PythonParser:
+    FUNCTION = re.compile(r"def\s+(\w+)\s*\(([^)]*)\)\s*(?:->\s*(\w+)\s*)?:$")
+    LET = re.compile(r"(\w+)\s*=\s*(?!=)(.+)$")
+    RETURN = re.compile(r"return\s+(.+)$")
+
+    @staticmethod
+    def split(code: str) -> list:
+        # Every unindented line starts a new top-level item
+        items = []
+        lines = []
+        for line in code.splitlines(keepends=True):
+            if lines and line.strip() and not line[0].isspace():
+                items.append("".join(lines))
+                lines = []
+            lines.append(line)
+        if lines:
+            items.append("".join(lines))
+        return items
+
+    def parse(self, code: str) -> Block:
+        lines = [line for line in code.splitlines() if line.strip()]
+        block, _ = self._block(lines, 0, 0)
+        return block
+
+    def _block(self, lines: list, index: int, indent: int) -> tuple:
+        statements = []
+        while index < len(lines):
+            line = lines[index]
+            text = line.strip()
+            if len(line) - len(line.lstrip()) < indent:
+                break
+            index += 1
+            if text.endswith(":"):
+                # The body is every following line indented past this one
+                body_indent = len(line) - len(line.lstrip()) + 1
+                if index < len(lines):
+                    next_line = lines[index]
+                    body_indent = max(
+                        body_indent, len(next_line) - len(next_line.lstrip())
+                    )
+                body, index = self._block(lines, index, body_indent)
+                match = self.FUNCTION.match(text)
+                if match:
+                    name, params, return_type = match.groups()
+                    statements.append(
+                        Function(name, _parse_params(params), return_type, body)
+                    )
+                else:
+                    statements.append(Compound(text[:-1].strip(), body))
+                continue
+            match = self.RETURN.match(text)
+            if match:
+                statements.append(Return(match[1]))
+                continue
+            match = self.LET.match(text)
+            if match:
+                statements.append(Let(*match.groups()))
+            elif text != "pass":
+                statements.append(Statement(text))
+        return Block(tuple(statements)), index
+
+
+class PythonEmitter:
+    TYPES = {"i32": "int", "i64": "int", "u32": "int", "u64": "int"}
+
+    def __init__(self):
+        self.indent = ""
+
+    def _params(self, params: tuple) -> str:
+        return ", ".join(
+            f"{name}: {self.TYPES.get(type_, type_)}" if type_ else name
+            for name, type_ in params
+        )
+
+    @visitor(Block)
+    def emit(self, block):
+        return "".join(self.emit(statement) for statement in block.statements)
+
+    @visitor(Function)
+    def emit(self, function):
+        returns = function.return_type
+        header = f"{self.indent}def {function.name}({self._params(function.params)})"
+        if returns:
+            header += f" -> {self.TYPES.get(returns, returns)}"
+        return header + ":\n" + self._body(function.body)
+
+    @visitor(Compound)
+    def emit(self, compound):
+        return f"{self.indent}{compound.header}:\n" + self._body(compound.body)
+
+    @visitor(Let)
+    def emit(self, let):
+        return f"{self.indent}{let.name} = {let.value}\n"
+
+    @visitor(Return)
+    def emit(self, statement):
+        return f"{self.indent}return {statement.value}\n"
+
+    @visitor(Statement)
+    def emit(self, statement):
+        return f"{self.indent}{statement.text}\n"
+
+    def _body(self, body: Block) -> str:
+        self.indent += "    "
+        try:
+            return self.emit(body) or f"{self.indent}pass\n"
+        finally:
+            self.indent = self.indent[:-4]
+
+    def join(self, items: list) -> str:
+        return "\n".join(items)
+
+
+class RustEmitter:
+    TYPES = {"int": "i32"}
+
+    def __init__(self):
+        self.indent = ""
+
+    def _params(self, params: tuple) -> str:
+        return ", ".join(
+            f"{name}: {self.TYPES.get(type_, type_)}" if type_ else name
+            for name, type_ in params
+        )
+
+    @visitor(Block)
+    def emit(self, block):
+        return "".join(self.emit(statement) for statement in block.statements)
+
+    @visitor(Function)
+    def emit(self, function):
+        returns = function.return_type
+        header = f"{self.indent}fn {function.name}({self._params(function.params)})"
+        if returns:
+            header += f" -> {self.TYPES.get(returns, returns)}"
+        return header + " {\n" + self._body(function.body)
+
+    @visitor(Compound)
+    def emit(self, compound):
+        return f"{self.indent}{compound.header} {{\n" + self._body(compound.body)
+
+    @visitor(Let)
+    def emit(self, let):
+        return f"{self.indent}let {let.name} = {let.value};\n"
+
+    @visitor(Return)
+    def emit(self, statement):
+        return f"{self.indent}return {statement.value};\n"
+
+    @visitor(Statement)
+    def emit(self, statement):
+        return f"{self.indent}{statement.text};\n"
+
+    def _body(self, body: Block) -> str:
+        self.indent += "    "
+        try:
+            text = self.emit(body)
+        finally:
+            self.indent = self.indent[:-4]
+        return text + f"{self.indent}}}\n"
+
+    def join(self, items: list) -> str:
+        # Items are separated by a blank line, with no newline after the last
+        return "\n".join(items)[:-1]
+
+
+PARSERS = {Language.RUST: RustParser(), Language.PYTHON: PythonParser()}
+EMITTERS = {Language.RUST: RustEmitter, Language.PYTHON: PythonEmitter}
+
+# Parsed sources and top-level items by (language, content hash)
+_PARSE_CACHE_MAXSIZE = 4096
+_parse_cache = OrderedDict()
+
+
+def _cached(key: tuple, parse):
+    tree = _parse_cache.get(key)
+    if tree is None:
+        tree = _parse_cache[key] = parse()
+        if len(_parse_cache) > _PARSE_CACHE_MAXSIZE:
+            _parse_cache.popitem(last=False)
+    else:
+        _parse_cache.move_to_end(key)
+    return tree
+
+
+def parse(code: str, language: Language) -> Module:
+    # Items are cached on their own, after an edit only the changed ones are
+    # parsed again and the others are the same objects as before
+    parser = PARSERS[language]
+
+    def parse_module():
+        return Module(
+            tuple(
+                _cached(
+                    (language, sha256(item.encode()).digest()),
+                    lambda: parser.parse(item),
+                )
+                for item in parser.split(code)
+            )
+        )
+
+    return _cached((Module, language, sha256(code.encode()).digest()), parse_module)
+
+
+class AstInterpreter(Expression):
+    # Translates through a syntax tree rather than rewriting text, so nested
+    # blocks are handled and unchanged items are neither parsed nor emitted
+    # again
+    def __init__(self, context: Context):
+        super().__init__(context)
+        if context.language_from not in PARSERS or context.language_to not in EMITTERS:
+            raise ValueError(
+                f"No syntax tree support for {context.language_from} to {context.language_to}"
+            )
+        self.emitter = EMITTERS[context.language_to]()
+        self._emitted = WeakKeyDictionary()
+
+    def __getstate__(self):
+        # Emitted items are a cache, a copy in another process starts empty
+        state = self.__dict__.copy()
+        del state["_emitted"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._emitted = WeakKeyDictionary()
+
+    def interpret(self, code: str) -> str:
+        module = parse(code, self.context.language_from)
+        items = []
+        for item in module.items:
+            text = self._emitted.get(item)
+            if text is None:
+                text = self._emitted[item] = self.emitter.emit(item)
+            items.append(text)
+        return self.emitter.join(items)
@@ -1,28 +1,400 @@
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import mmap
+import struct
+
+
 class PatriciaTrieNode:
+    __slots__ = ("key", "children", "is_end_of_word", "count")
+
     def __init__(self, key: str = ""):
+        # Edge label, a whole run of characters shared by every word below
         self.key = key
         self.children = {}
         self.is_end_of_word = False
+        # Number of words in this subtree
+        self.count = 0
+
+    def merge(self):
+        # Absorb the only child so no node is left with a single branch
+        (child,) = self.children.values()
+        self.key += child.key
+        self.children = child.children
+        self.is_end_of_word = child.is_end_of_word
+
 
+def _walk(stack: list, ordered: bool = False, reverse: bool = False):
+    # Stack entries are (node, path, word_only), where word_only entries
+    # just yield the node's own word once its children are done
+    push, pop = stack.append, stack.pop
+    while stack:
+        node, prefix, word_only = pop()
+        if word_only:
+            yield prefix
+            continue
+        children = node.children
+        if ordered:
+            children = [children[char] for char in sorted(children)]
+        else:
+            children = children.values()
+        if reverse:
+            if node.is_end_of_word:
+                push((node, prefix, True))
+        else:
+            if node.is_end_of_word:
+                yield prefix
+            children = reversed(children)
+        for child in children:
+            push((child, prefix + child.key, False))
 
-def traverse(node: PatriciaTrieNode, prefix: str):
-    if node.is_end_of_word:
-        yield prefix
-    for child in node.children.values():
-        yield from traverse(child, prefix + child.key)
+
+def traverse(
+    node: PatriciaTrieNode, prefix: str, ordered: bool = False, reverse: bool = False
+):
+    return _walk([(node, prefix, False)], ordered, reverse)
 
 
 class PatriciaTrie:
     def __init__(self):
         self.root = PatriciaTrieNode()
 
+    @classmethod
+    def from_sorted(cls, words):
+        # Sorted words only ever branch off the rightmost path, which is kept
+        # on a stack of (node, length of its path) instead of walking down
+        trie = cls()
+        stack = [(trie.root, 0)]
+        previous = None
+        for word in words:
+            if previous is not None and word <= previous:
+                if word == previous:
+                    continue
+                raise ValueError("Words must be sorted")
+            common = 0
+            if previous is not None:
+                limit = min(len(word), len(previous))
+                while common < limit and word[common] == previous[common]:
+                    common += 1
+            previous = word
+            last = None
+            while stack[-1][1] > common:
+                last = stack.pop()[0]
+            node, depth = stack[-1]
+            if depth < common:
+                # The word diverges inside the last popped edge, split it
+                split = PatriciaTrieNode(last.key[: common - depth])
+                split.count = last.count
+                last.key = last.key[common - depth :]
+                split.children[last.key[0]] = last
+                node.children[split.key[0]] = split
+                node, depth = split, common
+                stack.append((split, common))
+            if depth < len(word):
+                node = PatriciaTrieNode(word[depth:])
+                stack[-1][0].children[word[depth]] = node
+                stack.append((node, len(word)))
+            node.is_end_of_word = True
+            for parent, _ in stack:
+                parent.count += 1
+        return trie
+
+    def freeze(self):
+        # Lay the nodes out breadth first, so the children of every node are
+        # contiguous and a node is just an index into flat arrays
+        nodes = [self.root]
+        child_offsets = array("I")
+        for node in nodes:
+            child_offsets.append(len(nodes))
+            nodes.extend(node.children.values())
+        child_offsets.append(len(nodes))
+        labels = [node.key.encode() for node in nodes]
+        label_offsets = array("I", [0])
+        for label in labels:
+            label_offsets.append(label_offsets[-1] + len(label))
+        return FrozenPatriciaTrie(
+            label_offsets,
+            child_offsets,
+            array("I", [node.count for node in nodes]),
+            bytes(node.is_end_of_word for node in nodes),
+            b"".join(labels),
+        )
+
+    def _locate(self, prefix: str):
+        # Finds the topmost node whose words all start with the prefix
+        node = self.root
+        i = 0
+        while i < len(prefix):
+            child = node.children.get(prefix[i])
+            if child is None:
+                return None, ""
+            if prefix.startswith(child.key, i):
+                node = child
+                i += len(child.key)
+            elif child.key.startswith(prefix[i:]):
+                return child, prefix[:i] + child.key
+            else:
+                return None, ""
+        return node, prefix
+
     def insert(self, word: str):
+        if word in self:
+            return
         node = self.root
-        for char in word:
-            if char not in node.children:
-                node.children[char] = PatriciaTrieNode(char)
-            node = node.children[char]
+        node.count += 1
+        i = 0
+        while i < len(word):
+            child = node.children.get(word[i])
+            if child is None:
+                child = PatriciaTrieNode(word[i:])
+                child.count = 1
+                node.children[word[i]] = child
+                node = child
+                break
+            key = child.key
+            j = 1
+            while j < len(key) and i + j < len(word) and key[j] == word[i + j]:
+                j += 1
+            if j < len(key):
+                # The word diverges inside the edge, split it at that point
+                split = PatriciaTrieNode(key[:j])
+                split.count = child.count
+                child.key = key[j:]
+                split.children[child.key[0]] = child
+                node.children[word[i]] = split
+                child = split
+            node = child
+            node.count += 1
+            i += j
         node.is_end_of_word = True
 
+    def delete(self, word: str):
+        if word not in self:
+            raise ValueError("Word not found in trie")
+        path = []
+        node = self.root
+        i = 0
+        while i < len(word):
+            path.append(node)
+            node = node.children[word[i]]
+            i += len(node.key)
+        node.is_end_of_word = False
+        node.count -= 1
+        for parent in path:
+            parent.count -= 1
+        if node is self.root:
+            return
+        if not node.children:
+            del path[-1].children[node.key[0]]
+            node = path.pop()
+        if (
+            node is not self.root
+            and not node.is_end_of_word
+            and len(node.children) == 1
+        ):
+            node.merge()
+
+    def starts_with(self, prefix: str):
+        node, path = self._locate(prefix)
+        if node is not None:
+            yield from traverse(node, path)
+
+    def count_prefix(self, prefix: str):
+        node, _ = self._locate(prefix)
+        return node.count if node is not None else 0
+
+    def __contains__(self, word: str):
+        node, path = self._locate(word)
+        return node is not None and path == word and node.is_end_of_word
+
+    def iter_from(self, key: str, reverse: bool = False):
+        # Resumes a sorted iteration at the first word >= key (<= key in reverse)
+        stack = []
+        node = self.root
+        i = 0
+        while True:
+            if i == len(key):
+                if not reverse:
+                    stack.append((node, key, False))
+                elif node.is_end_of_word:
+                    stack.append((node, key, True))
+                break
+            if reverse and node.is_end_of_word:
+                stack.append((node, key[:i], True))
+            match = None
+            children = node.children
+            for char in sorted(children, reverse=not reverse):
+                child = children[char]
+                if char == key[i]:
+                    match = child
+                elif (char < key[i]) == reverse:
+                    stack.append((child, key[:i] + child.key, False))
+            if match is None:
+                break
+            if key.startswith(match.key, i):
+                node = match
+                i += len(match.key)
+                continue
+            path = key[:i] + match.key
+            if (path > key) != reverse:
+                stack.append((match, path, False))
+            break
+        return _walk(stack, True, reverse)
+
     def __iter__(self):
         return traverse(self.root, "")
+
+    def __reversed__(self):
+        return traverse(self.root, "", reverse=True)
+
+
+def _freeze_shard(words: list):
+    trie = PatriciaTrie()
+    for word in words:
+        trie.insert(word)
+    frozen = trie.freeze()
+    return (
+        frozen.label_offsets,
+        frozen.child_offsets,
+        frozen.counts,
+        frozen.ends,
+        frozen.labels,
+    )
+
+
+class FrozenPatriciaTrieNode:
+    __slots__ = ("trie", "index", "key")
+
+    def __init__(self, trie: "FrozenPatriciaTrie", index: int, key: str = ""):
+        self.trie = trie
+        self.index = index
+        self.key = key
+
+    @property
+    def children(self):
+        trie = self.trie
+        offsets, labels = trie.label_offsets, trie.labels
+        children = {}
+        for index in range(
+            trie.child_offsets[self.index], trie.child_offsets[self.index + 1]
+        ):
+            key = str(labels[offsets[index] : offsets[index + 1]], "utf-8")
+            children[key[0]] = FrozenPatriciaTrieNode(trie, index, key)
+        return children
+
+    @property
+    def is_end_of_word(self):
+        return bool(self.trie.ends[self.index])
+
+    @property
+    def count(self):
+        return self.trie.counts[self.index]
+
+
+# Read-only trie over flat arrays, searched and iterated like a PatriciaTrie
+class FrozenPatriciaTrie(PatriciaTrie):
+    # Magic, node count and labels size, followed by the arrays in native byte order
+    HEADER = struct.Struct("4sII")
+    MAGIC = b"PTRI"
+
+    def __init__(self, label_offsets, child_offsets, counts, ends, labels):
+        self.label_offsets = label_offsets
+        self.child_offsets = child_offsets
+        self.counts = counts
+        self.ends = ends
+        self.labels = labels
+        self.root = FrozenPatriciaTrieNode(self, 0)
+
+    @classmethod
+    def build_parallel(cls, words, max_workers: int = None):
+        # Words sharing a first character end up under the same root child,
+        # so every shard is built and frozen by its own process and the
+        # shards are grafted under the root in order of first appearance,
+        # the same order inserting them one by one gives
+        shards = {}
+        has_empty_word = False
+        for word in words:
+            if word:
+                shards.setdefault(word[0], []).append(word)
+            else:
+                has_empty_word = True
+        with ProcessPoolExecutor(max_workers) as executor:
+            frozen = list(executor.map(_freeze_shard, shards.values()))
+
+        # Breadth first levels of every shard below its own root, the next
+        # level being the children of the current one
+        levels = []
+        for _, child_offsets, *_ in frozen:
+            shard_levels = []
+            start, end = 1, 2
+            while start < end:
+                shard_levels.append((start, end))
+                start, end = child_offsets[start], child_offsets[end]
+            levels.append(shard_levels)
+
+        # Merged level by level, one segment per shard, which keeps the
+        # children of every node contiguous
+        label_offsets = array("I", [0, 0])
+        child_offsets = array("I", [1])
+        counts = array("I", [sum(shard[2][0] for shard in frozen) + has_empty_word])
+        ends = bytearray([has_empty_word])
+        labels = []
+        child_position = 1 + len(frozen)
+        for depth in range(max(map(len, levels), default=0)):
+            for shard, shard_levels in zip(frozen, levels):
+                if depth >= len(shard_levels):
+                    continue
+                shard_label_offsets, shard_child_offsets, shard_counts = shard[:3]
+                start, end = shard_levels[depth]
+                shift = label_offsets[-1] - shard_label_offsets[start]
+                label_offsets.extend(
+                    offset + shift
+                    for offset in shard_label_offsets[start + 1 : end + 1]
+                )
+                shift = child_position - shard_child_offsets[start]
+                child_offsets.extend(
+                    offset + shift for offset in shard_child_offsets[start:end]
+                )
+                child_position += shard_child_offsets[end] - shard_child_offsets[start]
+                counts.extend(shard_counts[start:end])
+                ends += shard[3][start:end]
+                labels.append(
+                    shard[4][shard_label_offsets[start] : shard_label_offsets[end]]
+                )
+        child_offsets.append(child_position)
+        return cls(label_offsets, child_offsets, counts, bytes(ends), b"".join(labels))
+
+    def insert(self, word: str):
+        raise TypeError("Frozen trie is read-only")
+
+    def delete(self, word: str):
+        raise TypeError("Frozen trie is read-only")
+
+    def freeze(self):
+        return self
+
+    def save(self, path: str):
+        with open(path, "wb") as file:
+            file.write(self.HEADER.pack(self.MAGIC, len(self.counts), len(self.labels)))
+            for data in (self.label_offsets, self.child_offsets, self.counts):
+                file.write(bytes(data))
+            file.write(self.ends)
+            file.write(self.labels)
+
+    @classmethod
+    def load(cls, path: str):
+        # The arrays are views into the mapped file, pages load on first use
+        with open(path, "rb") as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, nodes, labels_size = cls.HEADER.unpack_from(buffer)
+        if magic != cls.MAGIC:
+            raise ValueError("Not a frozen trie file")
+        view = memoryview(buffer)
+        offset = cls.HEADER.size
+        arrays = []
+        for length in (nodes + 1, nodes + 1, nodes):
+            size = length * array("I").itemsize
+            arrays.append(view[offset : offset + size].cast("I"))
+            offset += size
+        ends = view[offset : offset + nodes]
+        labels = view[offset + nodes : offset + nodes + labels_size]
+        return cls(*arrays, ends, labels)
@@ -1,3 +1,10 @@
+from array import array
+from collections import OrderedDict, deque
+import json
+import mmap
+import sys
+
+
 class Memento:
     def __init__(self, state):
         self._state = state
@@ -6,10 +13,263 @@ class Memento:
         return self._state
 
 
+class MementoHistory:
+    # Oldest mementos are evicted first once the count or bytes cap is hit,
+    # and identical states share a single memento
+    def __init__(self, max_count: int = None, max_bytes: int = None):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        # Evicted mementos are cleared and skipped by the head offset until
+        # they are half the list, so indexing stays constant time
+        self._mementos = []
+        self._head = 0
+        # State -> [shared memento, times it appears in the history]
+        self._shared = {}
+
+    def memento(self, state) -> Memento:
+        shared = self._shared.get(state)
+        return shared[0] if shared else Memento(state)
+
+    def append(self, memento: Memento) -> int:
+        state = memento.get_state()
+        shared = self._shared.get(state)
+        if shared is None:
+            shared = self._shared[state] = [memento, 0]
+            self.bytes += sys.getsizeof(state)
+        shared[1] += 1
+        self._mementos.append(shared[0])
+        return self._evict()
+
+    def _evict(self) -> int:
+        evicted = 0
+        while len(self) > 1 and (
+            (self.max_count is not None and len(self) > self.max_count)
+            or (self.max_bytes is not None and self.bytes > self.max_bytes)
+        ):
+            state = self._mementos[self._head].get_state()
+            self._mementos[self._head] = None
+            self._head += 1
+            shared = self._shared[state]
+            shared[1] -= 1
+            if not shared[1]:
+                del self._shared[state]
+                self.bytes -= sys.getsizeof(state)
+            evicted += 1
+        if self._head * 2 > len(self._mementos):
+            del self._mementos[: self._head]
+            self._head = 0
+        return evicted
+
+    def __getitem__(self, index: int) -> Memento:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Memento index out of range")
+        return self._mementos[self._head + index]
+
+    def __len__(self):
+        return len(self._mementos) - self._head
+
+
+def _common_prefix(a: str, b: str) -> int:
+    # Binary search over slice comparisons, which run in C
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[low:middle] == b[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _diff(old: str, new: str) -> tuple:
+    prefix = _common_prefix(old, new)
+    suffix = _common_prefix(old[prefix:][::-1], new[prefix:][::-1])
+    return prefix, suffix, new[prefix : len(new) - suffix]
+
+
+def _patch(old: str, diff: tuple) -> str:
+    prefix, suffix, middle = diff
+    return old[:prefix] + middle + old[len(old) - suffix :]
+
+
+class DiffMementoHistory:
+    # Keeps a full keyframe every keyframe_interval versions and the replaced
+    # span against the previous version in between, like video encoding
+    def __init__(
+        self,
+        keyframe_interval: int = 16,
+        max_count: int = None,
+        max_bytes: int = None,
+        cache_size: int = 8,
+    ):
+        self.keyframe_interval = keyframe_interval
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.cache_size = cache_size
+        self.bytes = 0
+        # Keyframe strings or (prefix, suffix, middle) diffs
+        self._entries = deque()
+        self._since_keyframe = 0
+        self._last_state = None
+        self._cache = OrderedDict()
+
+    def memento(self, state) -> Memento:
+        return Memento(state)
+
+    def _size(self, entry) -> int:
+        if isinstance(entry, str):
+            return sys.getsizeof(entry)
+        return sys.getsizeof(entry) + sys.getsizeof(entry[2])
+
+    def append(self, memento: Memento) -> int:
+        state = memento.get_state()
+        if (
+            self._last_state is None
+            or self._since_keyframe + 1 >= self.keyframe_interval
+        ):
+            entry = state
+            self._since_keyframe = 0
+        else:
+            entry = _diff(self._last_state, state)
+            self._since_keyframe += 1
+        self._entries.append(entry)
+        self.bytes += self._size(entry)
+        self._last_state = state
+        return self._evict()
+
+    def _evict(self) -> int:
+        evicted = 0
+        while len(self._entries) > 1 and (
+            (self.max_count is not None and len(self._entries) > self.max_count)
+            or (self.max_bytes is not None and self.bytes > self.max_bytes)
+        ):
+            # The next version becomes the keyframe its diffs build on
+            following = self._state(1)
+            self.bytes -= self._size(self._entries.popleft())
+            self.bytes += self._size(following) - self._size(self._entries[0])
+            self._entries[0] = following
+            # Rebuilt states are cached by index, which just shifted
+            self._cache.clear()
+            evicted += 1
+        return evicted
+
+    def _state(self, index: int) -> str:
+        if index == len(self._entries) - 1:
+            return self._last_state
+        if index in self._cache:
+            self._cache.move_to_end(index)
+            return self._cache[index]
+        keyframe = index
+        while not isinstance(self._entries[keyframe], str):
+            keyframe -= 1
+        state = self._entries[keyframe]
+        for position in range(keyframe + 1, index + 1):
+            state = _patch(state, self._entries[position])
+        self._cache[index] = state
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return state
+
+    def __getitem__(self, index: int) -> Memento:
+        if index < 0:
+            index += len(self._entries)
+        return Memento(self._state(index))
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SpillingMementoHistory:
+    # Keeps the newest mementos in memory and spills older states to an
+    # append-only archive file, read back through a memory map on demand
+    def __init__(self, path: str, resident_count: int = 256):
+        self.resident_count = resident_count
+        self.bytes = 0
+        self._mementos = deque()
+        # The archive only lives as long as the history, an existing file
+        # is never overwritten
+        self._file = open(path, "x+b")
+        # End offset of every archived state, its start is the previous end
+        self._offsets = array("Q", [0])
+        self._map = None
+
+    def memento(self, state) -> Memento:
+        return Memento(state)
+
+    def append(self, memento: Memento) -> int:
+        self._mementos.append(memento)
+        self.bytes += sys.getsizeof(memento.get_state())
+        while len(self._mementos) > self.resident_count:
+            state = self._mementos.popleft().get_state()
+            self.bytes -= sys.getsizeof(state)
+            data = state.encode()
+            self._file.write(data)
+            self._offsets.append(self._offsets[-1] + len(data))
+        # Nothing is lost, every version stays reachable
+        return 0
+
+    def _archived(self, index: int) -> str:
+        start, end = self._offsets[index], self._offsets[index + 1]
+        if start == end:
+            # Empty states take no bytes, the archive may even be empty
+            return ""
+        if self._map is None or len(self._map) < end:
+            # Remap to cover everything spilled since the last read
+            self._file.flush()
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map[start:end].decode()
+
+    def __getitem__(self, index: int) -> Memento:
+        if index < 0:
+            index += len(self)
+        archived = len(self._offsets) - 1
+        if index >= archived:
+            return self._mementos[index - archived]
+        if index < 0:
+            raise IndexError("Memento index out of range")
+        return Memento(self._archived(index))
+
+    def __len__(self):
+        return len(self._offsets) - 1 + len(self._mementos)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 class Poem:
-    def __init__(self, text: str = ""):
+    def __init__(
+        self,
+        text: str = "",
+        max_count: int = None,
+        max_bytes: int = None,
+        keyframe_interval: int = None,
+        archive_path: str = None,
+        resident_count: int = 256,
+    ):
         self._text = text
-        self.changes = [Memento(self.text)]
+        if archive_path:
+            # Every version is kept, on disk once it is not resident
+            if max_count or max_bytes or keyframe_interval:
+                raise ValueError("An archived history keeps full versions only")
+            self.changes = SpillingMementoHistory(archive_path, resident_count)
+        elif keyframe_interval:
+            self.changes = DiffMementoHistory(keyframe_interval, max_count, max_bytes)
+        else:
+            self.changes = MementoHistory(max_count, max_bytes)
+        self.changes.append(Memento(self.text))
         self._current = 0
 
     @property
@@ -18,9 +278,9 @@ class Poem:
 
     def set_text(self, text: str):
         self._text = text
-        m = Memento(self._text)
-        self.changes.append(m)
-        self._current += 1
+        m = self.changes.memento(self._text)
+        evicted = self.changes.append(m)
+        self._current = max(self._current + 1 - evicted, 0)
         return m
 
     def restore(self, memento: Memento):
@@ -44,5 +304,167 @@ class Poem:
             return m
         return None
 
+    def close(self):
+        # Releases the archive file, if the history has one
+        if isinstance(self.changes, SpillingMementoHistory):
+            self.changes.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def __str__(self):
         return self._text
+
+
+class UndoNode:
+    __slots__ = ("memento", "parent", "children", "active", "depth")
+
+    def __init__(self, memento: Memento, parent: "UndoNode" = None):
+        self.memento = memento
+        self.parent = parent
+        # Shared empty tuple until the first branch is added
+        self.children = ()
+        # Child that redo follows, the last one added or jumped through
+        self.active = None
+        self.depth = parent.depth + 1 if parent is not None else 0
+
+
+class UndoTree:
+    # Editing after an undo starts a new branch instead of dropping or
+    # appending after the undone states
+    def __init__(self, memento: Memento):
+        self.root = self.current = UndoNode(memento)
+        self.size = 1
+
+    def add(self, memento: Memento) -> UndoNode:
+        node = UndoNode(memento, self.current)
+        if not self.current.children:
+            self.current.children = []
+        self.current.children.append(node)
+        self.current.active = node
+        self.current = node
+        self.size += 1
+        return node
+
+    def undo(self) -> UndoNode:
+        if self.current.parent is None:
+            return None
+        self.current = self.current.parent
+        return self.current
+
+    def redo(self) -> UndoNode:
+        if self.current.active is None:
+            return None
+        self.current = self.current.active
+        return self.current
+
+    def jump(self, node: UndoNode) -> UndoNode:
+        # Climbs from both ends to the common ancestor, activating the path
+        # down to the target so redo keeps following it
+        current = self.current
+        while current.depth > node.depth:
+            current = current.parent
+        target = node
+        while target.depth > current.depth:
+            target.parent.active = target
+            target = target.parent
+        while current is not target:
+            current = current.parent
+            target.parent.active = target
+            target = target.parent
+        self.current = node
+        return node
+
+    def leaves(self):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(reversed(node.children))
+            else:
+                yield node
+
+    def save(self, path: str):
+        # One JSON line per node in depth-first order, [depth, state, is
+        # active, is current], so neither end holds the whole history at once
+        with open(path, "w", encoding="utf-8") as file:
+            stack = [self.root]
+            while stack:
+                node = stack.pop()
+                active = node.parent is not None and node.parent.active is node
+                line = [node.depth, node.memento.get_state(), active]
+                file.write(json.dumps(line + [node is self.current]) + "\n")
+                stack.extend(reversed(node.children))
+
+    @classmethod
+    def load(cls, path: str):
+        tree = None
+        # Ancestors of the node being read, a parent always precedes its children
+        path_nodes = []
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                depth, state, active, current = json.loads(line)
+                del path_nodes[depth:]
+                if tree is None:
+                    tree = cls(Memento(state))
+                    node = tree.root
+                else:
+                    parent = path_nodes[-1]
+                    node = UndoNode(Memento(state), parent)
+                    if not parent.children:
+                        parent.children = []
+                    parent.children.append(node)
+                    if active:
+                        parent.active = node
+                    tree.size += 1
+                if current:
+                    tree.current = node
+                path_nodes.append(node)
+        return tree
+
+    def __len__(self):
+        return self.size
+
+
+class BranchingPoem(Poem):
+    def __init__(self, text: str = ""):
+        self._text = text
+        self.changes = UndoTree(Memento(text))
+
+    def set_text(self, text: str):
+        self._text = text
+        m = Memento(text)
+        self.changes.add(m)
+        return m
+
+    def restore(self, memento: Memento):
+        self._text = memento.get_state()
+        self.changes.add(memento)
+
+    def _move(self, node: UndoNode):
+        if node is None:
+            return None
+        self._text = node.memento.get_state()
+        return node.memento
+
+    def undo(self):
+        return self._move(self.changes.undo())
+
+    def redo(self):
+        return self._move(self.changes.redo())
+
+    def jump(self, node: UndoNode):
+        return self._move(self.changes.jump(node))
+
+    def save(self, path: str):
+        self.changes.save(path)
+
+    @classmethod
+    def load(cls, path: str):
+        poem = cls()
+        poem.changes = UndoTree.load(path)
+        poem._text = poem.changes.current.memento.get_state()
+        return poem
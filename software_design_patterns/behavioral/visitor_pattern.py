@@ -1,3 +1,6 @@
+from enum import Enum
+from weakref import WeakKeyDictionary
+import numpy as np
 from shared.utils.visitor import visitor
 
 UNKNOWN_EXPRESSION = "Unknown expression type"
@@ -44,6 +47,26 @@ class ExpressionPrinter:
         return "".join(self.buffer)
 
 
+# Opts into the explicit-stack walk of @visitor for trees of any depth:
+# yielding a sub-expression visits it without recursing
+class IterativeExpressionPrinter(ExpressionPrinter):
+    @visitor(ValueExpression)
+    def visit(self, expression):
+        self.buffer.append(str(expression.value))
+
+    @visitor(ModuloExpression)
+    def visit(self, expression):
+        yield expression.left
+        self.buffer.append("%")
+        yield expression.right
+
+    @visitor(DivisionExpression)
+    def visit(self, expression):
+        yield expression.left
+        self.buffer.append("/")
+        yield expression.right
+
+
 class ExpressionEvaluator:
     def __init__(self):
         self.result = None
@@ -65,3 +88,142 @@ class ExpressionEvaluator:
         temp = self.result
         self.visit(expression.right)
         self.result = temp / self.result
+
+    # Repeated evaluations skip the tree walk by running the compiled form
+    def evaluate(self, expression):
+        self.result = ExpressionCompiler.compile(expression)()
+        return self.result
+
+
+class IterativeExpressionEvaluator(ExpressionEvaluator):
+    @visitor(ValueExpression)
+    def visit(self, expression):
+        self.result = expression.value
+
+    @visitor(ModuloExpression)
+    def visit(self, expression):
+        yield expression.left
+        temp = self.result
+        yield expression.right
+        self.result = temp % self.result
+
+    @visitor(DivisionExpression)
+    def visit(self, expression):
+        yield expression.left
+        temp = self.result
+        yield expression.right
+        self.result = temp / self.result
+
+
+class CompiledExpression:
+    def __init__(self, leaves, function):
+        self.leaves = leaves
+        self.function = function
+
+    def __call__(self, *values):
+        # Without explicit values the current leaf values are used
+        if not values:
+            values = [leaf.value for leaf in self.leaves]
+        return self.function(*values)
+
+
+# Turns an expression into one straight-line Python function of its leaf values
+class ExpressionCompiler:
+    _compiled = WeakKeyDictionary()
+
+    def __init__(self):
+        self.leaves = []
+        self.operands = []
+        self.lines = []
+
+    @visitor(ValueExpression)
+    def visit(self, expression):
+        self.operands.append(f"v{len(self.leaves)}")
+        self.leaves.append(expression)
+
+    @visitor(ModuloExpression)
+    def visit(self, expression):
+        yield expression.left
+        yield expression.right
+        self.emit("%")
+
+    @visitor(DivisionExpression)
+    def visit(self, expression):
+        yield expression.left
+        yield expression.right
+        self.emit("/")
+
+    def emit(self, operator):
+        right = self.operands.pop()
+        left = self.operands.pop()
+        temp = f"t{len(self.lines)}"
+        self.lines.append(f"    {temp} = {left} {operator} {right}")
+        self.operands.append(temp)
+
+    @classmethod
+    def compile(cls, expression):
+        if expression in cls._compiled:
+            return cls._compiled[expression]
+        compiler = cls()
+        compiler.visit(expression)
+        arguments = ", ".join(f"v{i}" for i in range(len(compiler.leaves)))
+        source = "\n".join(
+            [f"def function({arguments}):"]
+            + compiler.lines
+            + [f"    return {compiler.operands.pop()}"]
+        )
+        namespace = {}
+        exec(source, namespace)
+        compiled = CompiledExpression(compiler.leaves, namespace["function"])
+        # A lone leaf would be its own key held by its compiled function,
+        # never collected, and is cheap to compile again anyway
+        if compiler.lines:
+            cls._compiled[expression] = compiled
+        return compiled
+
+
+# Evaluates leaves holding NumPy arrays element-wise in a single tree walk
+class BatchExpressionEvaluator:
+    class ZeroDivision(Enum):
+        RAISE = "raise"
+        NAN = "nan"
+        MASK = "mask"
+
+    def __init__(self, zero_division: ZeroDivision = ZeroDivision.RAISE):
+        self.zero_division = zero_division
+        self.result = None
+
+    @visitor(ValueExpression)
+    def visit(self, expression):
+        if self.zero_division == self.ZeroDivision.RAISE:
+            self.result = np.asarray(expression.value)
+        else:
+            self.result = np.ma.asarray(expression.value)
+
+    @visitor(ModuloExpression)
+    def visit(self, expression):
+        yield expression.left
+        temp = self.result
+        yield expression.right
+        self.result = self.apply(np.mod, np.ma.mod, temp, self.result)
+
+    @visitor(DivisionExpression)
+    def visit(self, expression):
+        yield expression.left
+        temp = self.result
+        yield expression.right
+        self.result = self.apply(np.true_divide, np.ma.true_divide, temp, self.result)
+
+    def apply(self, operation, masked_operation, left, right):
+        if self.zero_division == self.ZeroDivision.RAISE:
+            if np.any(right == 0):
+                raise ZeroDivisionError("division by zero in batch")
+            return operation(left, right)
+        # Masked operations mask the rows with a zero divisor
+        return masked_operation(left, right)
+
+    def evaluate(self, expression):
+        self.visit(expression)
+        if self.zero_division == self.ZeroDivision.NAN:
+            self.result = self.result.astype(float).filled(np.nan)
+        return self.result
@@ -1,3 +1,6 @@
+import os
+import time
+from shared.constants.paths import TESTS_FILES_DIR
 from software_design_patterns.behavioral.command_pattern import *
 
 
@@ -37,3 +40,284 @@ def test_command_poem_copy_from_poem():
     command.execute()
     assert poem1.text == ""
     assert poem2.text == "Violets are blue\nRoses are red"
+
+
+def test_command_poem_undo_deltas():
+    poem = Poem("Roses are red")
+    write = PoemCommand(poem, PoemCommand.Action.WRITE, "!")
+    delete = PoemCommand(poem, PoemCommand.Action.DELETE, characters=5)
+
+    assert write.execute() == True
+    assert write.execute() == True
+    assert delete.execute() == True
+    assert poem.text == "Roses are "
+    assert write.undo_deltas == [1, 1]
+    assert delete.undo_deltas == ["red!!"]
+
+    assert delete.undo() == True
+    assert poem.text == "Roses are red!!"
+    assert write.undo() == True
+    assert write.undo() == True
+    assert poem.text == "Roses are red"
+    assert write.undo() == False
+
+
+def test_command_poem_text_buffer():
+    poem = Poem("Roses")
+    for word in [" are", " red", "\nViolets"]:
+        poem.write(word)
+    assert poem.text == "Roses are red\nViolets"
+
+    assert poem.delete(8) == "\nViolets"
+    assert poem.delete(5) == "e red"
+    poem.write("e blue")
+    assert str(poem) == "Roses are blue"
+
+    poem.text = "Sugar is sweet"
+    assert poem.delete(0) == ""
+    assert poem.text == "Sugar is sweet"
+
+
+def test_command_poem_journal():
+    JOURNAL_FILE_PATH = os.path.join(TESTS_FILES_DIR, "poems.journal")
+    os.makedirs(TESTS_FILES_DIR, exist_ok=True)
+
+    roses, violets = Poem("Roses are red"), Poem()
+    with CommandJournal(
+        JOURNAL_FILE_PATH,
+        {"roses": roses, "violets": violets},
+        batch_size=2,
+        snapshot_interval=4,
+    ) as journal:
+        journal.execute(PoemCommand(roses, PoemCommand.Action.WRITE, "\nViolets"))
+        delete = PoemCommand(roses, PoemCommand.Action.DELETE, characters=8)
+        journal.execute(delete)
+        journal.undo(delete)
+        journal.execute(CopyFromPoemCommand(roses, violets))
+        journal.execute(PoemCommand(violets, PoemCommand.Action.WRITE, " and blue"))
+    assert os.path.exists(JOURNAL_FILE_PATH + ".snapshot")
+
+    # A crash in the middle of a write leaves a torn record behind
+    with open(JOURNAL_FILE_PATH, "ab") as file:
+        file.write(b"\x00\x05")
+
+    poems = {}
+    with CommandJournal(JOURNAL_FILE_PATH, poems) as journal:
+        assert poems["roses"].text == ""
+        assert poems["violets"].text == "Roses are red\nViolets and blue"
+        journal.execute(PoemCommand(poems["roses"], PoemCommand.Action.WRITE, "!"))
+
+    poems = {}
+    CommandJournal(JOURNAL_FILE_PATH, poems).close()
+    assert poems["roses"].text == "!"
+
+    os.remove(JOURNAL_FILE_PATH)
+    os.remove(JOURNAL_FILE_PATH + ".snapshot")
+
+
+def test_command_poem_journal_without_snapshot():
+    JOURNAL_FILE_PATH = os.path.join(TESTS_FILES_DIR, "start.journal")
+    os.makedirs(TESTS_FILES_DIR, exist_ok=True)
+
+    roses, violets = Poem("Roses are red"), Poem("Violets")
+    with CommandJournal(
+        JOURNAL_FILE_PATH, {"roses": roses, "violets": violets}
+    ) as journal:
+        journal.execute(PoemCommand(roses, PoemCommand.Action.DELETE, characters=4))
+        journal.execute(PoemCommand(violets, PoemCommand.Action.WRITE, " are blue"))
+    assert not os.path.exists(JOURNAL_FILE_PATH + ".snapshot")
+
+    poems = {}
+    CommandJournal(JOURNAL_FILE_PATH, poems).close()
+    assert poems["roses"].text == "Roses are"
+    assert poems["violets"].text == "Violets are blue"
+
+    # Reopened with the current poems, the records are not applied twice
+    # and a poem new to the journal keeps its text
+    sugar = Poem("Sugar is sweet")
+    poems = {"roses": roses, "violets": violets, "sugar": sugar}
+    with CommandJournal(JOURNAL_FILE_PATH, poems) as journal:
+        assert poems["roses"] is roses
+        assert roses.text == "Roses are"
+        assert violets.text == "Violets are blue"
+        journal.execute(PoemCommand(sugar, PoemCommand.Action.WRITE, "!"))
+
+    poems = {}
+    CommandJournal(JOURNAL_FILE_PATH, poems).close()
+    assert poems["sugar"].text == "Sugar is sweet!"
+    assert poems["violets"].text == "Violets are blue"
+
+    os.remove(JOURNAL_FILE_PATH)
+
+
+def test_command_poem_journal_idle_sync():
+    JOURNAL_FILE_PATH = os.path.join(TESTS_FILES_DIR, "idle.journal")
+    os.makedirs(TESTS_FILES_DIR, exist_ok=True)
+
+    roses, violets = Poem("Roses are red"), Poem()
+    with CommandJournal(
+        JOURNAL_FILE_PATH, {"roses": roses}, batch_interval=0.01
+    ) as journal:
+        try:
+            journal.execute(CopyFromPoemCommand(roses, violets))
+            assert False
+        except ValueError:
+            pass
+        assert roses.text == "Roses are red"
+        assert violets.text == ""
+
+        # Nothing follows the write, the timer syncs the batch on its own
+        size = os.path.getsize(JOURNAL_FILE_PATH)
+        journal.execute(PoemCommand(roses, PoemCommand.Action.WRITE, "!"))
+        time.sleep(0.2)
+        assert not journal.pending
+        assert os.path.getsize(JOURNAL_FILE_PATH) > size
+
+    os.remove(JOURNAL_FILE_PATH)
+
+
+def test_command_poem_bus():
+    roses, violets = Poem(), Poem()
+    with CommandBus(max_workers=4) as bus:
+        futures = []
+        for i in range(100):
+            futures.append(
+                bus.execute(PoemCommand(roses, PoemCommand.Action.WRITE, f"{i},"))
+            )
+            futures.append(
+                bus.execute(PoemCommand(violets, PoemCommand.Action.WRITE, f"{i};"))
+            )
+        # Spans both poems, so it waits for the writes on either of them
+        composite = CompositePoemCommand(
+            [
+                PoemCommand(roses, PoemCommand.Action.DELETE, characters=3),
+                PoemCommand(violets, PoemCommand.Action.WRITE, "end"),
+            ]
+        )
+        futures.append(bus.execute(composite))
+        for future in futures:
+            future.result()
+        assert roses.text == "".join(f"{i}," for i in range(99))
+        assert violets.text == "".join(f"{i};" for i in range(100)) + "end"
+
+        bus.undo(composite).result()
+        assert roses.text == "".join(f"{i}," for i in range(100))
+        assert violets.text == "".join(f"{i};" for i in range(100))
+        assert bus.queue_depth() == 0
+        assert bus.queue_depth(roses) == 0
+        percentiles = bus.latency_percentiles()
+        assert list(percentiles) == [50, 90, 99]
+        assert percentiles[50] <= percentiles[90] <= percentiles[99]
+
+
+def test_command_poem_transaction():
+    poem = Poem("Roses are red")
+    transaction = TransactionalPoemCommand(
+        [
+            PoemCommand(poem, PoemCommand.Action.WRITE, "\nViolets are blue"),
+            PoemCommand(poem, PoemCommand.Action.DELETE, characters=5),
+            PoemCommand(poem, PoemCommand.Action.DELETE, characters=100),
+            PoemCommand(poem, PoemCommand.Action.WRITE, "never written"),
+        ]
+    )
+    assert transaction.execute() == False
+    assert poem.text == "Roses are red"
+    assert transaction.undo() == False
+
+    # Work before a savepoint survives a failure after it
+    transaction = TransactionalPoemCommand(
+        [PoemCommand(poem, PoemCommand.Action.WRITE, "\nViolets") for _ in range(10000)]
+    )
+    assert transaction.savepoint() == 10000
+    transaction.append(PoemCommand(poem, PoemCommand.Action.WRITE, " are blue"))
+    transaction.append(PoemCommand(poem, PoemCommand.Action.DELETE, characters=10**6))
+    assert transaction.execute() == False
+    assert poem.text == "Roses are red" + "\nViolets" * 10000
+    assert transaction.executed == 10000
+
+    transaction.rollback_to(9998)
+    assert poem.text == "Roses are red" + "\nViolets" * 9998
+    assert transaction.undo() == True
+    assert poem.text == "Roses are red"
+
+
+def test_command_poem_transaction_retry():
+    JOURNAL_FILE_PATH = os.path.join(TESTS_FILES_DIR, "retry.journal")
+    os.makedirs(TESTS_FILES_DIR, exist_ok=True)
+
+    poem = Poem("xy")
+    transaction = TransactionalPoemCommand(
+        [PoemCommand(poem, PoemCommand.Action.WRITE, "a")]
+    )
+    transaction.savepoint()
+    transaction.append(PoemCommand(poem, PoemCommand.Action.DELETE, characters=5))
+    with CommandJournal(JOURNAL_FILE_PATH, {"poem": poem}) as journal:
+        assert journal.execute(transaction) == False
+        # Resumes after the savepoint instead of writing again
+        assert journal.execute(transaction) == False
+    assert poem.text == "xya"
+    assert transaction.executed == 1
+
+    poems = {"poem": Poem("xy")}
+    CommandJournal(JOURNAL_FILE_PATH, poems).close()
+    assert poems["poem"].text == "xya"
+
+    assert transaction.undo() == True
+    assert poem.text == "xy"
+
+    os.remove(JOURNAL_FILE_PATH)
+
+
+def test_command_poem_history_undo_boundary():
+    poem = Poem()
+    history = CommandHistory()
+    history.execute(PoemCommand(poem, PoemCommand.Action.WRITE, "X"))
+    history.execute(PoemCommand(poem, PoemCommand.Action.DELETE, characters=1))
+    history.undo()
+    history.execute(PoemCommand(poem, PoemCommand.Action.WRITE, "Y"))
+    assert poem.text == "XY"
+    assert len(history) == 2
+
+    history.undo()
+    assert poem.text == "X"
+
+
+def test_command_poem_history_coalescing():
+    poem = Poem()
+    history = CommandHistory()
+    for char in "Roses are red":
+        history.execute(PoemCommand(poem, PoemCommand.Action.WRITE, char))
+    for _ in range(3):
+        history.execute(PoemCommand(poem, PoemCommand.Action.DELETE, characters=1))
+    assert poem.text == "Roses are "
+    assert len(history) == 2
+    assert history.merged == 14
+    assert history.saved_bytes > 0
+
+    assert history.undo() == True
+    assert poem.text == "Roses are red"
+    assert history.undo() == True
+    assert poem.text == ""
+    assert history.undo() == False
+    assert history.redo() == True
+    assert poem.text == "Roses are red"
+
+
+def test_command_poem_history_compaction():
+    poem = Poem()
+    # Nothing merges while typing, only when older history is compacted
+    history = CommandHistory(
+        TypingMergePolicy(window=-1), compact_every=10, keep_recent=3
+    )
+    for i in range(20):
+        history.execute(PoemCommand(poem, PoemCommand.Action.WRITE, str(i % 10)))
+    assert len(history) == 4
+    assert poem.text == "0123456789" * 2
+
+    # The three latest writes stay separate, the rest is a single step
+    history.undo()
+    history.undo()
+    history.undo()
+    assert poem.text == "01234567890123456"
+    history.undo()
+    assert poem.text == ""
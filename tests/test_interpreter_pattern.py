@@ -1,4 +1,9 @@
+import io
+import mmap
+import os
+import pathlib
 import pytest
+from shared.constants.paths import TESTS_FILES_DIR
 from software_design_patterns.behavioral.interpreter_pattern import *
 
 
@@ -22,3 +27,161 @@ def test_interpreter_rust_to_python():
     py_to_rs_interpreter = PythonToRustInterpreter()
     rust_code_converted_back = py_to_rs_interpreter.interpret(python_code)
     assert rust_code_converted_back == RUST_CODE
+
+
+def test_interpreter_shared_compiled_rules():
+    assert RustToPythonInterpreter().rules is RustToPythonInterpreter().rules
+    assert PythonToRustInterpreter().rules is not RustToPythonInterpreter().rules
+    with pytest.raises(ValueError):
+        GeneralInterpreter(Context(Language.RUST, Language.RUST)).interpret("")
+
+
+def test_interpreter_stream():
+    RUST_CODE = "\n\n".join(f"""fn add{i}(x: i32, y: i32) -> i32 {{
+    let result = x + y;
+    return result;
+}}""" for i in range(20))
+    python_code = RustToPythonInterpreter().interpret(RUST_CODE)
+
+    writer = io.StringIO()
+    RustToPythonInterpreter().interpret_stream(io.StringIO(RUST_CODE), writer, 7)
+    assert writer.getvalue() == python_code
+
+    RUST_FILE_PATH = os.path.join(TESTS_FILES_DIR, "add.rs")
+    os.makedirs(TESTS_FILES_DIR, exist_ok=True)
+    with open(RUST_FILE_PATH, "w", encoding="utf-8") as file:
+        file.write(RUST_CODE)
+    with open(RUST_FILE_PATH, "rb") as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    writer = io.StringIO()
+    RustToPythonInterpreter().interpret_stream(mapped, writer, 64)
+    mapped.close()
+    assert writer.getvalue() == python_code
+
+    # Braces in literals don't keep the stream from cutting between items
+    class LargestInput(RustToPythonInterpreter):
+        largest = 0
+
+        def interpret(self, code):
+            self.largest = max(self.largest, len(code))
+            return super().interpret(code)
+
+    LITERAL_CODE = "\n\n".join(f"""fn brace{i}() {{
+    let open = "{{";
+    let quote = '"';
+}}""" for i in range(200))
+    interpreter = LargestInput()
+    writer = io.StringIO()
+    interpreter.interpret_stream(io.StringIO(LITERAL_CODE), writer, 256)
+    assert writer.getvalue() == RustToPythonInterpreter().interpret(LITERAL_CODE)
+    assert interpreter.largest < 512
+
+    PYTHON_CODE = """def add(x: int, y: int) -> int:
+    result = x + y
+    return result
+"""
+    rust_code = PythonToRustInterpreter().interpret(PYTHON_CODE)
+    for chunk_size in (5, 1 << 20):
+        writer = io.StringIO()
+        PythonToRustInterpreter().interpret_stream(
+            io.StringIO(PYTHON_CODE * 3), writer, chunk_size
+        )
+        assert writer.getvalue() == rust_code * 3
+
+    os.remove(RUST_FILE_PATH)
+
+
+def test_interpreter_batch():
+    SOURCES = [f"""fn add{i % 5}(x: i32, y: i32) -> i32 {{
+    let result = x + y;
+    return result;
+}}""" for i in range(20)]
+    RUST_FILE_PATH = os.path.join(TESTS_FILES_DIR, "add.rs")
+    os.makedirs(TESTS_FILES_DIR, exist_ok=True)
+    with open(RUST_FILE_PATH, "w", encoding="utf-8") as file:
+        file.write(SOURCES[0])
+
+    interpreter = RustToPythonInterpreter()
+    expected = [interpreter.interpret(source) for source in SOURCES]
+    with BatchInterpreter(interpreter, max_workers=2, chunksize=2) as batch:
+        assert batch.translate(SOURCES) == expected
+        assert len(batch.cache) == 5
+
+        sources = SOURCES + [pathlib.Path(RUST_FILE_PATH), "fn"]
+        results = dict(batch.translate_as_completed(sources))
+        assert [results[i] for i in range(len(sources))] == expected + [
+            expected[0],
+            "fn",
+        ]
+        assert len(batch.cache) == 6
+        assert batch.translate(["x = 1\n"]) == ["x = 1\n"]
+        cache = batch.cache
+
+    # A cache shared between directions and interpreters keeps them apart
+    with BatchInterpreter(PythonToRustInterpreter(), 1, cache=cache) as batch:
+        assert batch.translate(["x = 1\n"]) == ["let x = 1;\n"]
+    ast_interpreter = AstInterpreter(Context(Language.RUST, Language.PYTHON))
+    with BatchInterpreter(ast_interpreter, 1, cache=cache) as batch:
+        assert batch.translate(SOURCES[:1]) == [ast_interpreter.interpret(SOURCES[0])]
+    assert len(cache) == 9
+
+    os.remove(RUST_FILE_PATH)
+
+
+def test_interpreter_ast():
+    RUST_CODE = """fn outer(x: i32) -> i32 {
+    fn inner(y: i32) -> i32 {
+        if y > 0 {
+            return y;
+        }
+        return 0;
+    }
+    let z = inner(x);
+    return z;
+}
+
+fn main() {
+    let text = "{;}";
+}"""
+    EXPECTED_PYTHON_CODE = """def outer(x: int) -> int:
+    def inner(y: int) -> int:
+        if y > 0:
+            return y
+        return 0
+    z = inner(x)
+    return z
+
+def main():
+    text = "{;}"
+"""
+    rs_to_py_interpreter = AstInterpreter(Context(Language.RUST, Language.PYTHON))
+    python_code = rs_to_py_interpreter.interpret(RUST_CODE)
+    assert python_code == EXPECTED_PYTHON_CODE
+
+    local_scope = {}
+    exec(python_code, {}, local_scope)
+    assert local_scope["outer"](-2) == 0
+
+    py_to_rs_interpreter = AstInterpreter(Context(Language.PYTHON, Language.RUST))
+    assert py_to_rs_interpreter.interpret(python_code) == RUST_CODE
+
+    tree = parse(RUST_CODE, Language.RUST)
+    assert parse(RUST_CODE, Language.RUST) is tree
+    edited = parse(RUST_CODE.replace('"{;}"', '"{}"'), Language.RUST)
+    assert edited.items[0] is tree.items[0]
+    assert edited.items[1] is not tree.items[1]
+
+    with pytest.raises(ValueError):
+        parse("fn broken() {", Language.RUST)
+    with pytest.raises(ValueError, match="Unterminated"):
+        parse('let s = "abc', Language.RUST)
+
+    # Quotes and braces in char literals are not syntax
+    CHAR_CODE = """fn main() {
+    let q = '"';
+    let b = '{';
+}"""
+    assert rs_to_py_interpreter.interpret(CHAR_CODE) == """def main():
+    q = '"'
+    b = '{'
+"""
@@ -1,3 +1,6 @@
+import os
+import pytest
+from shared.constants.paths import TESTS_FILES_DIR
 from software_design_patterns.behavioral.iterator_pattern import *
 
 
@@ -12,3 +15,134 @@ def test_iterator_patricia_trie():
     assert words == ["cat", "car", "cart", "dog"]
     assert len(words) == 4
     assert "cat" in words
+
+
+def test_iterator_patricia_trie_compression():
+    trie = PatriciaTrie()
+    trie.insert("romane")
+    trie.insert("romanus")
+    trie.insert("romulus")
+    trie.insert("rom")
+
+    assert [child.key for child in trie.root.children.values()] == ["rom"]
+    rom = trie.root.children["r"]
+    assert rom.is_end_of_word
+    assert [child.key for child in rom.children.values()] == ["an", "ulus"]
+    assert [child.key for child in rom.children["a"].children.values()] == ["e", "us"]
+    assert list(trie) == ["rom", "romane", "romanus", "romulus"]
+
+
+def test_iterator_patricia_trie_prefix_search():
+    trie = PatriciaTrie()
+    for word in ["car", "cart", "carbon", "cat", "dog"]:
+        trie.insert(word)
+
+    assert "cart" in trie
+    assert "ca" not in trie
+    assert "cars" not in trie
+
+    matches = trie.starts_with("car")
+    assert next(matches) == "car"
+    assert list(matches) == ["cart", "carbon"]
+    assert list(trie.starts_with("do")) == ["dog"]
+    assert list(trie.starts_with("x")) == []
+
+    assert trie.count_prefix("ca") == 4
+    assert trie.count_prefix("carb") == 1
+    assert trie.count_prefix("") == 5
+
+    trie.delete("cart")
+    trie.delete("carbon")
+    assert list(trie) == ["car", "cat", "dog"]
+    assert trie.count_prefix("car") == 1
+
+    # "ca" is left with a single branch, so it merges back into "cat"
+    trie.delete("car")
+    assert [child.key for child in trie.root.children.values()] == ["cat", "dog"]
+
+    with pytest.raises(ValueError, match="Word not found in trie"):
+        trie.delete("car")
+
+
+def test_iterator_patricia_trie_ordered():
+    trie = PatriciaTrie()
+    for word in ["dog", "cat", "cart", "car", "ant"]:
+        trie.insert(word)
+
+    assert list(trie) == ["dog", "cat", "car", "cart", "ant"]
+    assert list(reversed(trie)) == ["ant", "cart", "car", "cat", "dog"]
+    assert list(traverse(trie.root, "", ordered=True)) == [
+        "ant",
+        "car",
+        "cart",
+        "cat",
+        "dog",
+    ]
+
+    # Paging through the words with a cursor
+    assert list(trie.iter_from("car")) == ["car", "cart", "cat", "dog"]
+    assert list(trie.iter_from("carp")) == ["cart", "cat", "dog"]
+    assert list(trie.iter_from("cart", reverse=True)) == ["cart", "car", "ant"]
+    assert list(trie.iter_from("e")) == []
+
+
+def test_iterator_patricia_trie_deep():
+    # Every word branches off the previous one, one node per level
+    trie = PatriciaTrie()
+    for length in range(1, 2001):
+        trie.insert("a" * length)
+
+    assert sum(1 for _ in trie) == 2000
+    assert next(reversed(trie)) == "a" * 2000
+    assert next(trie.iter_from("a" * 1999 + "b"), None) is None
+
+
+def test_iterator_patricia_trie_from_sorted():
+    trie = PatriciaTrie.from_sorted(["ant", "car", "car", "carbon", "cart", "cat"])
+
+    assert list(trie) == ["ant", "car", "carbon", "cart", "cat"]
+    assert [child.key for child in trie.root.children.values()] == ["ant", "ca"]
+    assert trie.count_prefix("car") == 3
+
+    with pytest.raises(ValueError, match="Words must be sorted"):
+        PatriciaTrie.from_sorted(["dog", "cat"])
+
+
+def test_iterator_patricia_trie_frozen():
+    trie = PatriciaTrie()
+    for word in ["dog", "cat", "cart", "car", "ant", "añejo"]:
+        trie.insert(word)
+
+    frozen = trie.freeze()
+    TRIE_FILE_PATH = os.path.join(TESTS_FILES_DIR, "words.ptri")
+    os.makedirs(TESTS_FILES_DIR, exist_ok=True)
+    frozen.save(TRIE_FILE_PATH)
+    loaded = FrozenPatriciaTrie.load(TRIE_FILE_PATH)
+    os.remove(TRIE_FILE_PATH)
+
+    for copy in (frozen, loaded):
+        assert list(copy) == list(trie)
+        assert list(reversed(copy)) == list(reversed(trie))
+        assert list(copy.iter_from("car")) == ["car", "cart", "cat", "dog"]
+        assert list(copy.starts_with("a")) == ["ant", "añejo"]
+        assert copy.count_prefix("ca") == 3
+        assert "cart" in copy
+        assert "ca" not in copy
+
+    with pytest.raises(TypeError, match="Frozen trie is read-only"):
+        loaded.insert("cow")
+
+
+def test_iterator_patricia_trie_build_parallel():
+    WORDS = ["dog", "cat", "cart", "", "door", "car", "ant", "cat", "dove"]
+
+    trie = PatriciaTrie()
+    for word in WORDS:
+        trie.insert(word)
+    parallel = FrozenPatriciaTrie.build_parallel(WORDS, max_workers=2)
+
+    assert list(parallel) == list(trie)
+    assert list(parallel.iter_from("cas")) == list(trie.iter_from("cas"))
+    assert parallel.count_prefix("") == 8
+    assert parallel.count_prefix("do") == 3
+    assert parallel.child_offsets == trie.freeze().child_offsets
@@ -1,3 +1,7 @@
+import os
+import pytest
+import sys
+from shared.constants.paths import TESTS_FILES_DIR
 from software_design_patterns.behavioral.memento_pattern import *
 
 
@@ -28,3 +32,127 @@ def test_memento_poem():
     memento4 = poem.redo()
     assert poem.text == VERSE_3
     assert memento4.get_state() == VERSE_3
+
+
+def test_memento_poem_bounded_history():
+    poem = Poem("verse 0", max_count=3)
+    for i in range(1, 6):
+        poem.set_text(f"verse {i}")
+    assert len(poem.changes) == 3
+
+    assert poem.undo().get_state() == "verse 4"
+    assert poem.undo().get_state() == "verse 3"
+    assert poem.undo() is None
+    assert poem.text == "verse 3"
+
+
+def test_memento_poem_shared_states():
+    VERSE = "Que putas haces con mi corazón"
+
+    poem = Poem(VERSE)
+    memento = poem.set_text(VERSE.upper())
+    assert poem.set_text(VERSE).get_state() == VERSE
+    assert poem.changes[0] is poem.changes[2]
+
+    size = poem.changes.bytes
+    poem.restore(memento)
+    poem.restore(memento)
+    assert len(poem.changes) == 5
+    assert poem.changes.bytes == size
+
+    poem = Poem(VERSE, max_bytes=2 * size // 3)
+    poem.set_text(VERSE.upper())
+    assert len(poem.changes) == 1
+    assert poem.changes.bytes <= 2 * size // 3
+    assert poem.undo() is None
+
+
+def test_memento_poem_keyframes():
+    verses = [f"{i} " + "Que putas haces con mi corazón\n" * 20 for i in range(10)]
+
+    poem = Poem(verses[0], keyframe_interval=4)
+    for verse in verses[1:]:
+        poem.set_text(verse)
+    assert len(poem.changes) == 10
+    assert poem.changes.bytes < sum(map(sys.getsizeof, verses)) // 2
+
+    for verse in reversed(verses[:-1]):
+        assert poem.undo().get_state() == verse
+    assert poem.undo() is None
+    for verse in verses[1:]:
+        assert poem.redo().get_state() == verse
+
+    poem = Poem(verses[0], max_count=3, keyframe_interval=4)
+    for verse in verses[1:]:
+        poem.set_text(verse)
+    assert [poem.changes[i].get_state() for i in range(3)] == verses[-3:]
+
+    # The last verse alone nearly fills the budget, several versions go at once
+    poem = Poem(verses[0], max_bytes=1500, keyframe_interval=8)
+    for verse in verses[1:5]:
+        poem.set_text(verse)
+    poem.changes[1]
+    poem.set_text(verses[5] * 2)
+    kept = len(poem.changes)
+    assert kept < 5
+    states = verses[6 - kept : 5] + [verses[5] * 2]
+    assert [poem.changes[i].get_state() for i in range(kept)] == states
+
+
+def test_memento_poem_undo_tree():
+    poem = BranchingPoem("Roses are red")
+    poem.set_text("Roses are red, violets are blue")
+    assert poem.undo().get_state() == "Roses are red"
+    poem.set_text("Roses are red, the sky is blue")
+    leaf = poem.changes.current
+
+    assert poem.undo().get_state() == "Roses are red"
+    assert poem.redo().get_state() == "Roses are red, the sky is blue"
+    assert poem.redo() is None
+    assert len(poem.changes) == 3
+
+    first, second = poem.changes.leaves()
+    assert poem.jump(first).get_state() == "Roses are red, violets are blue"
+    poem.undo()
+    assert poem.redo().get_state() == "Roses are red, violets are blue"
+
+    TREE_FILE_PATH = os.path.join(TESTS_FILES_DIR, "poem.undo")
+    os.makedirs(TESTS_FILES_DIR, exist_ok=True)
+    poem.jump(leaf)
+    poem.save(TREE_FILE_PATH)
+    loaded = BranchingPoem.load(TREE_FILE_PATH)
+    assert loaded.text == "Roses are red, the sky is blue"
+    assert len(loaded.changes) == 3
+    assert loaded.undo().get_state() == "Roses are red"
+    assert loaded.redo().get_state() == "Roses are red, the sky is blue"
+
+    os.remove(TREE_FILE_PATH)
+
+
+def test_memento_poem_archive():
+    ARCHIVE_FILE_PATH = os.path.join(TESTS_FILES_DIR, "poem.archive")
+    os.makedirs(TESTS_FILES_DIR, exist_ok=True)
+
+    with Poem("verse 0", archive_path=ARCHIVE_FILE_PATH, resident_count=2) as poem:
+        for i in range(1, 6):
+            poem.set_text(f"verso {i} ñ")
+        assert len(poem.changes) == 6
+        assert poem.changes[1].get_state() == "verso 1 ñ"
+
+        for i in reversed(range(1, 5)):
+            assert poem.undo().get_state() == f"verso {i} ñ"
+        assert poem.undo().get_state() == "verse 0"
+        assert poem.redo().get_state() == "verso 1 ñ"
+
+    with pytest.raises(ValueError, match="full versions"):
+        Poem("verse 0", max_count=3, archive_path=ARCHIVE_FILE_PATH)
+    with pytest.raises(FileExistsError):
+        Poem("verse 0", archive_path=ARCHIVE_FILE_PATH)
+    os.remove(ARCHIVE_FILE_PATH)
+
+    # Only empty states archived, nothing was written to the file
+    with Poem(archive_path=ARCHIVE_FILE_PATH, resident_count=1) as poem:
+        poem.set_text("x")
+        assert poem.undo().get_state() == ""
+        assert poem.text == ""
+    os.remove(ARCHIVE_FILE_PATH)
@@ -1,3 +1,5 @@
+import gc
+import numpy as np
 from software_design_patterns.behavioral.visitor_pattern import *
 
 
@@ -44,3 +46,190 @@ def test_visitor_modulo_division():
     evaluator = ExpressionEvaluator()
     evaluator.visit(expr)
     assert evaluator.result == 5 % 2 / 3
+
+
+def test_visitor_dispatch_per_class():
+    class LeafCounter:
+        def __init__(self):
+            self.leaves = 0
+
+        @visitor(ValueExpression)
+        def visit(self, expression):
+            self.leaves += 1
+
+        @visitor(DivisionExpression)
+        def visit(self, expression):
+            self.visit(expression.left)
+            self.visit(expression.right)
+
+    # 8 / 4 / 2
+    expr = DivisionExpression(
+        DivisionExpression(ValueExpression(8), ValueExpression(4)), ValueExpression(2)
+    )
+
+    counter = LeafCounter()
+    counter.visit(expr)
+    assert counter.leaves == 3
+
+    evaluator = ExpressionEvaluator()
+    evaluator.visit(expr)
+    assert evaluator.result == 8 / 4 / 2
+
+    try:
+        counter.visit(ModuloExpression(ValueExpression(5), ValueExpression(2)))
+        assert False
+    except KeyError as e:
+        assert e.args[0] is ModuloExpression
+
+
+def test_visitor_dispatch_subclass():
+    class IntegerExpression(ValueExpression):
+        pass
+
+    # 7 % 4 / 2
+    expr = DivisionExpression(
+        ModuloExpression(IntegerExpression(7), IntegerExpression(4)),
+        IntegerExpression(2),
+    )
+
+    printer = ExpressionPrinter()
+    printer.visit(expr)
+    assert str(printer) == "7%4/2"
+
+    info = ExpressionPrinter.visit.cache_info()
+    assert info.currsize >= 3
+    assert 0 < info.hit_rate < 1
+
+    printer.visit(expr)
+    assert ExpressionPrinter.visit.cache_info().hits == info.hits + 5
+
+
+def test_visitor_dispatch_same_qualname():
+    def make_tagger(tag):
+        class Tagger:
+            @visitor(object)
+            def visit(self, expression):
+                return tag
+
+        return Tagger
+
+    first = make_tagger("first")
+    second = make_tagger("second")
+    assert first().visit(ValueExpression(1)) == "first"
+    assert second().visit(ValueExpression(1)) == "second"
+
+
+def test_visitor_dispatch_cache_invalidation():
+    class Tagger:
+        @visitor(object)
+        def visit(self, expression):
+            return "object"
+
+    tagger = Tagger()
+    assert tagger.visit(ValueExpression(1)) == "object"
+    assert Tagger.visit.cache_info().currsize == 1
+
+    # A more specific method replaces the resolved type remembered before
+    Tagger.visit.register(ValueExpression, lambda self, expression: "value")
+    assert Tagger.visit.cache_info().currsize == 0
+    assert tagger.visit(ValueExpression(1)) == "value"
+    assert tagger.visit(ModuloExpression(None, None)) == "object"
+
+    # A generator method switches the class to the walking dispatcher
+    visited = []
+
+    def visit_modulo(self, expression):
+        yield expression.left
+        visited.append("%")
+        yield expression.right
+
+    Tagger.visit.register(ModuloExpression, visit_modulo)
+    tagger.visit(ModuloExpression(ValueExpression(1), ValueExpression(2)))
+    assert visited == ["%"]
+
+
+def test_visitor_iterative_matches_recursive():
+    # 9 % 4 / (7 / 2 % 3)
+    expr = DivisionExpression(
+        ModuloExpression(ValueExpression(9), ValueExpression(4)),
+        ModuloExpression(
+            DivisionExpression(ValueExpression(7), ValueExpression(2)),
+            ValueExpression(3),
+        ),
+    )
+    for printer, evaluator in (
+        (ExpressionPrinter(), ExpressionEvaluator()),
+        (IterativeExpressionPrinter(), IterativeExpressionEvaluator()),
+    ):
+        printer.visit(expr)
+        assert str(printer) == "9%4/7/2%3"
+        evaluator.visit(expr)
+        assert evaluator.result == 9 % 4 / (7 / 2 % 3)
+
+
+def test_visitor_deep_expression():
+    # 100000 % 7 % 8 % ... % 20006, deeper than the recursion limit
+    expr = ValueExpression(100000)
+    for value in range(7, 20007):
+        expr = ModuloExpression(expr, ValueExpression(value))
+
+    printer = IterativeExpressionPrinter()
+    printer.visit(expr)
+    assert str(printer) == "%".join(map(str, [100000] + list(range(7, 20007))))
+
+    evaluator = IterativeExpressionEvaluator()
+    evaluator.visit(expr)
+    assert evaluator.result == 100000 % 7
+
+
+def test_visitor_compiled_expression():
+    # 17 % 5 / 4
+    left = ValueExpression(17)
+    expr = DivisionExpression(
+        ModuloExpression(left, ValueExpression(5)), ValueExpression(4)
+    )
+
+    evaluator = ExpressionEvaluator()
+    assert evaluator.evaluate(expr) == 17 % 5 / 4
+    assert evaluator.result == 17 % 5 / 4
+
+    compiled = ExpressionCompiler.compile(expr)
+    assert ExpressionCompiler.compile(expr) is compiled
+    assert compiled(9, 4, 2) == 9 % 4 / 2
+
+    left.value = 23
+    assert evaluator.evaluate(expr) == 23 % 5 / 4
+
+    # Compiled trees don't keep themselves alive
+    leaf = ValueExpression(3)
+    assert ExpressionCompiler.compile(leaf)() == 3
+    del expr, leaf
+    gc.collect()
+    assert len(ExpressionCompiler._compiled) == 0
+
+
+def test_visitor_batch_expression():
+    # a % b / c over three rows
+    expr = DivisionExpression(
+        ModuloExpression(
+            ValueExpression(np.array([17, 9, 8])), ValueExpression(np.array([5, 4, 3]))
+        ),
+        ValueExpression(np.array([4, 0, 2])),
+    )
+
+    try:
+        BatchExpressionEvaluator().evaluate(expr)
+        assert False
+    except ZeroDivisionError as e:
+        assert str(e) == "division by zero in batch"
+
+    nan = BatchExpressionEvaluator(BatchExpressionEvaluator.ZeroDivision.NAN)
+    result = nan.evaluate(expr)
+    assert result[0] == 17 % 5 / 4
+    assert np.isnan(result[1])
+    assert result[2] == 8 % 3 / 2
+
+    mask = BatchExpressionEvaluator(BatchExpressionEvaluator.ZeroDivision.MASK)
+    result = mask.evaluate(expr)
+    assert list(result.mask) == [False, True, False]
+    assert result.compressed().tolist() == [17 % 5 / 4, 8 % 3 / 2]